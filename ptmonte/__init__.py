@@ -8,9 +8,16 @@ File: forcefield
 
 from .constants import *
 from .atom import Atom
-from .structure import Lattice, Adsorbent, Box
+from .cell import CellList
+from .structure import Container, Lattice, Adsorbent, Box
 from .forcefield import ForceField
-from .step import Step, StepTranslation, StepAdd, StepRemove
-from .simulation import Simulation, GrandCanonicalSimulation
+from .grid import EnergyGrid, OccupancyMap
+from .step import Step, StepTranslation, StepAdd, StepRemove, StepVolume, StepSwap
+from .simulation import Simulation, GrandCanonicalSimulation, GibbsEnsembleSimulation
+from .isotherm import Isotherm
+from .tempering import ReplicaExchangeSimulation
+from .trajectory import TrajectoryWriter, read_trajectory
+from .statistics import BlockAverage
+from .widom import Widom
 
 __version__ = '0.1'
@@ -17,11 +17,14 @@ class Atom:
         
     def copy(self):
         new_atom = Atom()
-        new_atom.x = self.x
-        new_atom.y = self.y
-        new_atom.z = self.z
-        new_atom.a_type = self.a_type
-        new_atom.p_index = self.p_index
-        new_atom.charge = self.charge
+        new_atom.copy_from(self)
         return new_atom
 
+    def copy_from(self, atom):
+        self.x = atom.x
+        self.y = atom.y
+        self.z = atom.z
+        self.a_type = atom.a_type
+        self.p_index = atom.p_index
+        self.charge = atom.charge
+
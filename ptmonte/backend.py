@@ -0,0 +1,122 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: backend
+'''
+
+import math
+import warnings
+import numpy as np
+from .constants import *
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Scalar Abramowitz and Stegun 7.1.26, the same approximation as forcefield.erfc
+def _erfc(x):
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    return t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429)))) * math.exp(-x * x)
+
+def _shortest_r2(d0, d1, d2, to_cartesian, to_internal):
+    '''Squared minimum image distance through the fractional coordinate, valid for any cell'''
+    f0 = to_internal[0,0] * d0 + to_internal[0,1] * d1 + to_internal[0,2] * d2
+    f1 = to_internal[1,0] * d0 + to_internal[1,1] * d1 + to_internal[1,2] * d2
+    f2 = to_internal[2,0] * d0 + to_internal[2,1] * d1 + to_internal[2,2] * d2
+    f0 -= np.rint(f0)
+    f1 -= np.rint(f1)
+    f2 -= np.rint(f2)
+    r2 = 0.0
+    for c in range(3):
+        d = to_cartesian[c,0] * f0 + to_cartesian[c,1] * f1 + to_cartesian[c,2] * f2
+        r2 += d * d
+    return r2
+
+def _pair_energy(r2, i, j, qq, c12, c6, lj_shift, wolf, alpha, wolf_shift, wolf_force, cutoff):
+    '''Energy of a pair of types i, j and charge product qq inside the cutoff'''
+    r6 = 1.0 / (r2 * r2 * r2)
+    en = (c12[i,j] * r6 - c6[i,j]) * r6 - lj_shift[i,j]
+    if qq != 0.0:
+        r = math.sqrt(r2)
+        if wolf:
+            en += ELECTRIC_CONSTANT * qq * (_erfc(alpha * r) / r - wolf_shift + wolf_force * (r - cutoff))
+        else:
+            en += ELECTRIC_CONSTANT * qq / r
+    return en
+
+def _pair_kernel(pos_a, pos_b, to_cartesian, to_internal, p_a, q_a, p_b, q_b,
+                 c12, c6, lj_shift, cutoff2, core2, wolf, alpha, wolf_shift, wolf_force, cutoff,
+                 energy, mask):
+    '''Pair energy of row k of the b arrays with row k of the a arrays, or row 0 when they have one row
+    Fill energy and mask (inside the cutoff), return True on a hard-core overlap'''
+    overlap = False
+    single = pos_a.shape[0] == 1
+    for k in range(pos_b.shape[0]):
+        a = 0 if single else k
+        r2 = _shortest_r2(pos_b[k,0] - pos_a[a,0],pos_b[k,1] - pos_a[a,1],pos_b[k,2] - pos_a[a,2],to_cartesian,to_internal)
+        if r2 <= 0.00001 or r2 >= cutoff2:
+            mask[k] = False
+            energy[k] = 0.0
+            continue
+        mask[k] = True
+        i = p_a[a]
+        j = p_b[k]
+        if r2 < core2[i,j]:
+            overlap = True
+        energy[k] = _pair_energy(r2,i,j,q_a[a] * q_b[k],c12,c6,lj_shift,wolf,alpha,wolf_shift,wolf_force,cutoff)
+    return overlap
+
+def _trial_kernel(coord, pos, index, to_cartesian, to_internal, p_a, q_a, p_b, q_b, exclude,
+                  c12, c6, lj_shift, cutoff2, core2, wolf, alpha, wolf_shift, wolf_force, cutoff,
+                  energy):
+    '''Energy of a particle of type p_a and charge q_a at each row of coord with the particles of pos
+    Row k uses the candidates index[k], or index[0] when index has one row, -1 and exclude are skipped
+    Fill energy, infinite on a hard-core overlap'''
+    shared = index.shape[0] == 1
+    for k in range(coord.shape[0]):
+        row = 0 if shared else k
+        en = 0.0
+        for t in range(index.shape[1]):
+            b = index[row,t]
+            if b < 0 or b == exclude:
+                continue
+            r2 = _shortest_r2(pos[b,0] - coord[k,0],pos[b,1] - coord[k,1],pos[b,2] - coord[k,2],to_cartesian,to_internal)
+            if r2 <= 0.00001 or r2 >= cutoff2:
+                continue
+            j = p_b[b]
+            if r2 < core2[p_a,j]:
+                en = math.inf
+                break
+            en += _pair_energy(r2,p_a,j,q_a * q_b[b],c12,c6,lj_shift,wolf,alpha,wolf_shift,wolf_force,cutoff)
+        energy[k] = en
+
+if numba is not None:
+    _erfc = numba.njit(cache = True)(_erfc)
+    _shortest_r2 = numba.njit(cache = True)(_shortest_r2)
+    _pair_energy = numba.njit(cache = True)(_pair_energy)
+    _pair_kernel = numba.njit(cache = True)(_pair_kernel)
+    _trial_kernel = numba.njit(cache = True)(_trial_kernel)
+
+BACKENDS = ('auto','numpy','numba')
+
+def pair_kernel(name):
+    '''Compiled pair kernel of the backend, None for the NumPy path'''
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend '+name)
+    if name == 'numpy':
+        return None
+    if numba is None:
+        if name == 'numba':
+            warnings.warn('Numba is not installed, the NumPy backend is used')
+        return None
+    return _pair_kernel
+
+def trial_kernel(name):
+    '''Compiled kernel scoring many positions of one particle type, None for the NumPy path'''
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend '+name)
+    if name == 'numpy' or numba is None:
+        return None
+    return _trial_kernel
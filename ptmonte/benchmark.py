@@ -0,0 +1,214 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: benchmark
+'''
+
+import sys
+import copy
+import json
+import time
+import platform
+import argparse
+import numpy as np
+from .atom import Atom
+from .structure import Lattice
+from .forcefield import ForceField
+from .simulation import GrandCanonicalSimulation, GibbsEnsembleSimulation
+
+# Translations of a face centred lattice, every atom of the asymmetric unit appears 4 times
+SYMMETRY = ['x,y,z','x+1/2,y+1/2,z','x+1/2,y,z+1/2','x,y+1/2,z+1/2']
+
+SHAPES = {'cubic': (90.0,90.0,90.0), 'triclinic': (80.0,95.0,105.0)}
+
+ADSORBATE = 'CH4_sp3'
+
+def synthetic_forcefield(n_type = 4, cutoff = 12.0, coulomb = 'bare', seed = 0):
+    '''Force field with n_type framework types F0_, F1_, ... and the methane adsorbate'''
+    rng = np.random.default_rng(seed)
+    ff = ForceField()
+    ff.p_type = ['F{}_'.format(i) for i in range(n_type)] + [ADSORBATE]
+    ff.raw_sigma = rng.uniform(2.5,3.5,n_type).tolist() + [3.73]
+    ff.raw_epsilon = rng.uniform(20.0,60.0,n_type).tolist() + [148.0]
+    ff.cutoff = cutoff
+    ff.shift = True
+    ff.coulomb = coulomb
+    ff.init()
+    return ff
+
+def synthetic_lattice(side = 25.0, n_atom = 100, shape = 'cubic', n_type = 4, seed = 0):
+    '''Framework of 4 * n_atom random atoms, n_atom in the asymmetric unit'''
+    rng = np.random.default_rng(seed)
+    lattice = Lattice()
+    lattice.a = lattice.b = lattice.c = side
+    lattice.alpha, lattice.beta, lattice.gamma = SHAPES[shape]
+    for op in SYMMETRY:
+        x, y, z = op.split(',')
+        lattice.symmetry_x.append(x)
+        lattice.symmetry_y.append(y)
+        lattice.symmetry_z.append(z)
+    frac = rng.random((n_atom,3)) * 0.5 # The symmetry copies fill the rest of the cell
+    for i, f in enumerate(frac):
+        atom = Atom()
+        atom.x, atom.y, atom.z = f
+        atom.a_type = 'F{}_{}'.format(i % n_type,i)
+        atom.charge = 0.1 * ((-1) ** i)
+        lattice.internal_atoms.append(atom)
+    return lattice
+
+def synthetic_framework(ff, side = 25.0, n_atom = 100, shape = 'cubic', seed = 0):
+    '''Synthetic lattice indexed by ff, expanded to a supercell with a cell list for its cutoff'''
+    lattice = synthetic_lattice(side,n_atom,shape,seed = seed)
+    lattice.init()
+    ff.set_index(lattice)
+    lattice.supercell(ff.cutoff)
+    lattice.init_cells(ff.cutoff)
+    return lattice
+
+def synthetic_simulation(lattice, ff, loading, seed = 0, k_trial = 1):
+    '''Simulation with loading adsorbate particles placed at random where their energy is negative'''
+    simulation = GrandCanonicalSimulation()
+    simulation.temperature = 298.15
+    simulation.pressure = 1e6
+    simulation.d_max = 1.0
+    simulation.k_trial = k_trial
+    simulation.k_translation = k_trial
+    simulation.seed(seed)
+    simulation.setup(lattice,ff,ADSORBATE)
+    template = simulation.steps[1].atom
+    while len(simulation.adsorbent) < loading:
+        atom = template.copy()
+        atom.x, atom.y, atom.z = np.dot(lattice.to_cartesian,simulation.rng.array(3))
+        if ff.one_atom(atom,lattice) + ff.one_atom(atom,simulation.adsorbent) < 0:
+            simulation.adsorbent.append(atom)
+    simulation.recompute()
+    return simulation
+
+def synthetic_gibbs(lattice, ff, loading, n_particle = 100, seed = 0):
+    '''Gibbs simulation with loading adsorbate particles and n_particle in the bulk box
+    The force field is copied without the shift and with the tail correction, as the Gibbs ensemble needs'''
+    ff = copy.copy(ff)
+    ff.shift = False
+    ff.tail = True
+    ff.init()
+    simulation = GibbsEnsembleSimulation()
+    simulation.temperature = 298.15
+    simulation.pressure = 1e6
+    simulation.d_max = 1.0
+    simulation.n_particle = n_particle
+    simulation.seed(seed)
+    simulation.setup(lattice,ff,ADSORBATE)
+    template = simulation.box.get(0)
+    while len(simulation.adsorbent) < loading:
+        atom = template.copy()
+        atom.x, atom.y, atom.z = np.dot(lattice.to_cartesian,simulation.rng.array(3))
+        if ff.one_atom(atom,lattice) + ff.one_atom(atom,simulation.adsorbent) < 0:
+            simulation.adsorbent.append(atom)
+    simulation.recompute()
+    return simulation
+
+def step_name(step):
+    name = type(step).__name__
+    if getattr(step,'in_box',False):
+        name += '[box]'
+    if getattr(step,'k_trial',1) > 1:
+        name += '[k={}]'.format(step.k_trial)
+    return name
+
+def time_setup(lattice):
+    start = time.perf_counter()
+    lattice.init()
+    return time.perf_counter() - start
+
+def time_energy(simulation, repeat = 3):
+    '''Best time of a full energy evaluation from scratch'''
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        simulation.ff.particle_energies(simulation.adsorbent,simulation.lattice)
+        simulation.ff.total(simulation.adsorbent,simulation.lattice)
+        best = min(best,time.perf_counter() - start)
+    return best
+
+def time_step(simulation, k, n_step):
+    '''Attempted moves per second and acceptance of step k alone, the particles and the box are restored afterward
+    A removal from an empty adsorbent is not an attempt, so the loading may drift during the timing'''
+    step = simulation.steps[k]
+    state = simulation.adsorbent.state()
+    box = simulation.box
+    if box is not None:
+        box_state, side = box.state(), box.side
+    step.reset()
+    start = time.perf_counter()
+    for i in range(n_step):
+        step.run(lattice = simulation.lattice,adsorbent = simulation.adsorbent,box = box)
+    elapsed = time.perf_counter() - start
+    rate = step.total / elapsed if step.total > 0 else None # JSON has no NaN
+    acceptance = step.accept_rate() if step.total > 0 else None
+    simulation.adsorbent.set_state(state)
+    if box is not None:
+        box.set_side(side)
+        box.set_state(box_state)
+    simulation.recompute()
+    return rate, acceptance
+
+def accepted(rate, acceptance):
+    '''Accepted moves per second, the figure that compares single and multiple-try moves at equal cost'''
+    return None if rate is None else rate * acceptance
+
+def run_benchmarks(sides = (25.0,), n_atoms = (100,), shapes = ('cubic','triclinic'), loadings = (0,20,80),
+                   n_step = 2000, k_trial = 8, cutoff = 12.0, seed = 0, n_box = 100):
+    '''Dictionary of the setup, energy and move timings of every synthetic system'''
+    ff = synthetic_forcefield(cutoff = cutoff,seed = seed)
+    result = {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                       'backend': 'numpy' if ff.kernel is None else 'numba', 'n_step': n_step, 'cutoff': cutoff, 'n_box': n_box,
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'setup': [], 'energy': [], 'steps': []}
+    for shape in shapes:
+        for side in sides:
+            for n_atom in n_atoms:
+                system = {'shape': shape, 'side': side, 'n_atom': n_atom}
+                lattice = synthetic_lattice(side,n_atom,shape,seed = seed)
+                seconds = time_setup(lattice)
+                result['setup'].append(dict(system,n_framework = len(lattice),seconds = seconds))
+                lattice = synthetic_framework(ff,side,n_atom,shape,seed)
+                for loading in loadings:
+                    simulation = synthetic_simulation(lattice,ff,loading,seed,k_trial)
+                    result['energy'].append(dict(system,loading = loading,seconds = time_energy(simulation)))
+                    simulations = [('grand canonical',simulation)]
+                    if k_trial > 1:
+                        simulations.append(('grand canonical',synthetic_simulation(lattice,ff,loading,seed)))
+                    if n_box > 0:
+                        simulations.append(('gibbs',synthetic_gibbs(lattice,ff,loading,n_box,seed)))
+                    for ensemble, simulation in simulations:
+                        for k, step in enumerate(simulation.steps):
+                            rate, acceptance = time_step(simulation,k,n_step)
+                            result['steps'].append(dict(system,loading = loading,ensemble = ensemble,step = step_name(step),
+                                                        moves_per_second = rate,acceptance = acceptance,
+                                                        accepted_per_second = accepted(rate,acceptance)))
+    return result
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark of the Monte Carlo moves on synthetic frameworks')
+    parser.add_argument('--output', help = 'JSON file, standard output when missing')
+    parser.add_argument('--side', type = float, nargs = '+', default = [25.0])
+    parser.add_argument('--n-atom', type = int, nargs = '+', default = [100], help = 'atoms of the asymmetric unit')
+    parser.add_argument('--shape', nargs = '+', default = ['cubic','triclinic'], choices = sorted(SHAPES))
+    parser.add_argument('--loading', type = int, nargs = '+', default = [0,20,80])
+    parser.add_argument('--steps', type = int, default = 2000, help = 'moves timed for each step')
+    parser.add_argument('--k-trial', type = int, default = 8, help = 'trials of the multiple-try moves, 1 to skip')
+    parser.add_argument('--cutoff', type = float, default = 12.0)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--box-particles', type = int, default = 100, help = 'particles of the bulk box of the Gibbs system, 0 to skip')
+    args = parser.parse_args(argv)
+    result = run_benchmarks(args.side,args.n_atom,args.shape,args.loading,args.steps,args.k_trial,args.cutoff,args.seed,args.box_particles)
+    if args.output is None:
+        json.dump(result,sys.stdout,indent = 1)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output,'w') as f:
+            json.dump(result,f,indent = 1)
+
+if __name__ == '__main__':
+    main()
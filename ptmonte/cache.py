@@ -0,0 +1,48 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: cache
+'''
+
+import os
+import shutil
+import hashlib
+from .structure import Lattice
+
+def content_hash(*file_names, extra = ''):
+    h = hashlib.sha1()
+    for file_name in file_names:
+        with open(file_name,'rb') as f:
+            h.update(f.read())
+    h.update(extra.encode())
+    return h.hexdigest()
+
+def cached_lattice(directory, lattice_file, ff_file, ff, tolerance = 0.01, cutoff = None):
+    '''Load the expanded and indexed framework from directory, read the CIF and save it if missing
+    With a cutoff the saved framework is already the supercell, so the memory-mapped arrays are used as they are'''
+    key = content_hash(lattice_file, ff_file, extra = 'supercell:{}:{}'.format(tolerance,cutoff))
+    path = os.path.join(directory, key)
+    lattice = Lattice()
+    if os.path.isdir(path):
+        lattice.load_arrays(path)
+        return lattice
+    lattice.tolerance = tolerance
+    lattice.read_cif(lattice_file)
+    lattice.init()
+    ff.set_index(lattice)
+    if cutoff is not None:
+        lattice.supercell(cutoff)
+    save_directory(directory, key, lattice.save_arrays)
+    return lattice
+
+def save_directory(directory, key, save):
+    '''Call save on a temporary directory and move it to directory/key in one step'''
+    path = os.path.join(directory, key)
+    temp = os.path.join(directory, '{}.{}.tmp'.format(key,os.getpid()))
+    save(temp)
+    try:
+        os.replace(temp, path) # Other jobs never see a partial directory
+    except OSError:
+        shutil.rmtree(temp, ignore_errors = True) # Saved by another job in the meantime
+    return path
@@ -0,0 +1,109 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: cell
+'''
+
+import itertools
+import numpy as np
+
+def perpendicular_widths(to_cartesian):
+    '''Distance between opposite faces of the cell'''
+    a, b, c = to_cartesian.T
+    volume = abs(np.dot(a,np.cross(b,c)))
+    return volume / np.array([np.linalg.norm(np.cross(b,c)),np.linalg.norm(np.cross(c,a)),np.linalg.norm(np.cross(a,b))])
+
+# Cell list over the fractional coordinate, updated particle by particle
+class CellList:
+    def __init__(self):
+        self.cutoff = 0.0
+        self.shape = np.ones(3,dtype=int)
+        self.to_internal = np.identity(3)
+        self.table = np.zeros((0,0),dtype=int) # Particle index of each cell, -1 for empty slot
+        self.count = np.zeros(0,dtype=int)
+        self.cell_of = np.zeros(0,dtype=int)
+        self.slot_of = np.zeros(0,dtype=int)
+        self.neighbor = np.zeros((0,27),dtype=int) # The 27 cells around each cell
+
+    def init(self, container, cutoff):
+        '''Return False when the cell is too small for a 3x3x3 cell grid'''
+        self.cutoff = cutoff
+        self.to_internal = container.to_internal
+        self.shape = np.floor(perpendicular_widths(container.to_cartesian) / cutoff).astype(int)
+        if np.any(self.shape < 3):
+            return False
+        n_cell = int(np.prod(self.shape))
+        index = np.arange(n_cell).reshape(self.shape)
+        self.neighbor = np.zeros((n_cell,27),dtype=int)
+        for k, shift in enumerate(itertools.product((-1,0,1),repeat=3)):
+            self.neighbor[:,k] = np.roll(index,shift,axis=(0,1,2)).ravel()
+        self.count = np.zeros(n_cell,dtype=int)
+        self.table = -np.ones((n_cell,max(4,2*len(container)//n_cell+1)),dtype=int)
+        self.cell_of = np.zeros(max(16,len(container)),dtype=int)
+        self.slot_of = np.zeros(max(16,len(container)),dtype=int)
+        for i, c in enumerate(self.cells(container.pos)):
+            self.insert(i,c)
+        return True
+
+    def cells(self, coord):
+        '''Cell index of an (n,3) array of cartesian coordinate'''
+        f = np.dot(coord,self.to_internal.T)
+        f = np.floor((f - np.floor(f)) * self.shape).astype(int) % self.shape
+        return (f[:,0] * self.shape[1] + f[:,1]) * self.shape[2] + f[:,2]
+
+    def cell(self, coord):
+        return int(self.cells(np.reshape(coord,(1,3)))[0])
+
+    def insert(self, i, c):
+        if i >= len(self.cell_of):
+            self.cell_of = np.concatenate((self.cell_of,np.zeros(len(self.cell_of),dtype=int)))
+            self.slot_of = np.concatenate((self.slot_of,np.zeros(len(self.slot_of),dtype=int)))
+        if self.count[c] == self.table.shape[1]:
+            self.table = np.concatenate((self.table,-np.ones(self.table.shape,dtype=int)),axis=1)
+        self.table[c,self.count[c]] = i
+        self.cell_of[i] = c
+        self.slot_of[i] = self.count[c]
+        self.count[c] += 1
+
+    def delete(self, i):
+        c = self.cell_of[i]
+        last = self.count[c] - 1
+        j = self.table[c,last]
+        self.table[c,self.slot_of[i]] = j
+        self.slot_of[j] = self.slot_of[i]
+        self.table[c,last] = -1
+        self.count[c] = last
+
+    def rename(self, old, new):
+        '''Particle old is now stored at index new'''
+        self.table[self.cell_of[old],self.slot_of[old]] = new
+        self.cell_of[new] = self.cell_of[old]
+        self.slot_of[new] = self.slot_of[old]
+
+    def move(self, i, coord):
+        c = self.cell(coord)
+        if c != self.cell_of[i]:
+            self.delete(i)
+            self.insert(i,c)
+
+    def candidates(self, coord):
+        '''Index of the particles in the cells around coord'''
+        index = self.table[self.neighbor[self.cell(coord)]].ravel()
+        return index[index >= 0]
+
+    def candidates_many(self, coord):
+        '''(k, 27*m) index of the particles around each coordinate, -1 for empty slot'''
+        return self.table[self.neighbor[self.cells(coord)]].reshape(len(coord),-1)
+
+    def pairs(self):
+        '''Index arrays i < j of every pair of particles in neighbour cells'''
+        first = []
+        second = []
+        for k in range(27):
+            a = self.table[:,:,None]
+            b = self.table[self.neighbor[:,k]][:,None,:]
+            mask = (a >= 0) & (a < b)
+            first.append(np.broadcast_to(a,mask.shape)[mask])
+            second.append(np.broadcast_to(b,mask.shape)[mask])
+        return np.concatenate(first), np.concatenate(second)
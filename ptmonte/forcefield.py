@@ -8,6 +8,13 @@ File: forcefield
 import math
 import numpy as np
 from .constants import *
+from .backend import pair_kernel, trial_kernel
+
+def erfc(x):
+    '''Complementary error function for arrays, Abramowitz and Stegun 7.1.26 (error below 1.5e-7)'''
+    t = 1.0 / (1.0 + 0.3275911 * x)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return poly * np.exp(-x * x)
 
 class ForceField:
     def __init__(self):
@@ -17,26 +24,77 @@ class ForceField:
         self.epsilon4 = None
         self.p_type = []
         self.p_type_missing = []
+        self.cutoff = None # Angstrom, no truncation when None
+        self.shift = False # Shift the Lennard-Jones energy to zero at the cutoff
+        self.tail = False # Add the tail correction beyond the cutoff
+        self.coulomb = 'bare' # 'bare' or 'wolf' (damped shifted force, needs the cutoff)
+        self.alpha = 0.2 # Wolf damping parameter in 1/Angstrom
+        self.core_factor = None # Reject pairs closer than core_factor * sigma, no hard core when None
+        self.core2 = None
+        self.backend = 'auto' # 'numpy', 'numba' or 'auto' for Numba when installed
+        self.kernel = None
+        self.trial_kernel = None # Compiled many_atoms for one particle type
+        self.kernel_args = ()
+        self.mixing = 'lorentz-berthelot' # or 'jorgensen', geometric sigma
+        self.c12 = None
+        self.c6 = None
+        self.lookup = {} # Index of every type already resolved
+        self.frame_tail = (None,None) # type_count of the lattice and the tail energy of each type with it
+        self.wildcard = [] # (prefix length, {prefix: index}) of the types ending with _
         
     def init(self):
-        n = len(self.p_type)
-        self.sigma2 = np.zeros((n,n))
-        self.epsilon4 = np.zeros((n,n))
-        for i in range(n-1):
-            for j in range(i+1,n):
-                self.sigma2[i,j] = (self.raw_sigma[i] + self.raw_sigma[j])**2/4
-                self.sigma2[j,i] = self.sigma2[i,j]
-                self.epsilon4[i,j] = 4*math.sqrt(self.raw_epsilon[i]*self.raw_epsilon[j])
-                self.epsilon4[j,i] = self.epsilon4[i,j]
-        for i in range(n):
-            self.sigma2[i,i] = self.raw_sigma[i] ** 2
-            self.epsilon4[i,i] = 4 * self.raw_epsilon[i]
+        sigma = np.array(self.raw_sigma,dtype=float)
+        epsilon = np.array(self.raw_epsilon,dtype=float)
+        if self.mixing == 'lorentz-berthelot':
+            sigma = (sigma[:,None] + sigma[None,:]) / 2
+        elif self.mixing == 'jorgensen':
+            sigma = np.sqrt(sigma[:,None] * sigma[None,:])
+        else:
+            raise ValueError('Unknown mixing rule '+self.mixing)
+        self.sigma2 = sigma ** 2
+        self.epsilon4 = 4 * np.sqrt(epsilon[:,None] * epsilon[None,:])
+        # Coefficients of r**-12 and r**-6, the kernels only read these tables
+        self.c12 = self.epsilon4 * self.sigma2 ** 6
+        self.c6 = self.epsilon4 * self.sigma2 ** 3
+        self.lj_shift = np.zeros(self.c12.shape)
+        self.tail_table = np.zeros(self.c12.shape)
+        self.frame_tail = (None,None)
+        if self.cutoff is not None:
+            self.cutoff2 = self.cutoff ** 2
+            rc = self.cutoff
+            if self.shift:
+                self.lj_shift = self.c12 / rc ** 12 - self.c6 / rc ** 6
+            # Tail energy of a homogeneous mixture is sum N_i N_j tail_table[i,j] / V
+            self.tail_table = 2 * math.pi / 3 * (self.c12 / (3 * rc ** 9) - self.c6 / rc ** 3)
+        self.init_lookup()
+        if self.core_factor is not None:
+            self.core2 = self.core_factor ** 2 * self.sigma2
+        if self.coulomb == 'wolf':
+            if self.cutoff is None:
+                raise ValueError('Wolf electrostatics needs a cutoff')
+            rc = self.cutoff
+            a = self.alpha
+            self.wolf_shift = float(erfc(a*rc)) / rc
+            self.wolf_force = float(erfc(a*rc)) / rc**2 + 2*a/math.sqrt(math.pi) * math.exp(-(a*rc)**2) / rc
+            self.wolf_self = -ELECTRIC_CONSTANT * (float(erfc(a*rc)) / (2*rc) + a/math.sqrt(math.pi)) # Times q**2
+        elif self.coulomb != 'bare':
+            raise ValueError('Unknown electrostatics '+self.coulomb)
+        self.kernel = pair_kernel(self.backend)
+        self.trial_kernel = trial_kernel(self.backend)
+        if self.kernel is not None:
+            n = len(self.p_type)
+            wolf = self.coulomb == 'wolf'
+            self.kernel_args = (self.c12, self.c6, self.lj_shift,
+                self.cutoff2 if self.cutoff is not None else math.inf,
+                self.core2 if self.core2 is not None else np.zeros((n,n)),
+                wolf, self.alpha, self.wolf_shift if wolf else 0.0, self.wolf_force if wolf else 0.0,
+                float(self.cutoff) if self.cutoff is not None else 0.0)
         
     def read_raspa_def(self,file_name):
         f = open(file_name,'r')
-        temp = None
-        for i in range(5):
-            temp = f.readline()
+        header = [f.readline().strip() for i in range(5)]
+        self.shift = header[1] == 'shifted'
+        self.tail = header[3] == 'yes'
         n = int(f.readline())
         temp = f.readline()
         for i in range(n):
@@ -48,62 +106,318 @@ class ForceField:
                 self.raw_sigma.append(float(temp[3]))
             else:
                 self.p_type_missing.append(temp[0])
+        for temp in f:
+            temp = temp.strip().lower()
+            if temp in ('lorentz-berthelot','jorgensen'):
+                self.mixing = temp
         f.close()
         
-    def set_atom(self,atom):
-        good = False
-        # Check for exact match
+    def init_lookup(self):
+        '''Exact names in a dict, wildcards X_ in one dict per prefix length'''
+        self.lookup = {}
+        prefixes = {}
         for num, p_type in enumerate(self.p_type):
-            if atom.a_type == p_type:
-                good = True
-                atom.p_index = num
-                break
-        # Check for partial match
-        if not good:
-            for num, p_type in enumerate(self.p_type):
-                if p_type[-1] == '_' :
-                    ind = p_type.find('_')
-                    if p_type[:ind] == atom.a_type[:ind]:
-                        good = True
-                        atom.p_index = num
-                        break
-        # Raise error when the type not match
-        if not good:
-            raise ValueError('The program cannot detect the type '+a.a_type+' in the Force Field')
-    
+            self.lookup.setdefault(p_type,num)
+            if p_type[-1] == '_':
+                ind = p_type.find('_')
+                prefixes.setdefault(ind,{}).setdefault(p_type[:ind],num)
+        self.wildcard = sorted(prefixes.items())
+
+    def find_type(self,a_type):
+        '''Index of an exact match, otherwise of the first wildcard X_ with a_type starting with X'''
+        num = self.lookup.get(a_type)
+        if num is None:
+            found = [table[a_type[:ind]] for ind, table in self.wildcard if a_type[:ind] in table]
+            if not found:
+                raise ValueError('The program cannot detect the type '+a_type+' in the Force Field')
+            num = min(found) # First in the file like the linear scan
+            self.lookup[a_type] = num
+        return num
+
+    def set_atom(self,atom):
+        atom.p_index = self.find_type(atom.a_type)
     
-    def set_index(self,container): # Set a_index
-        for a in container.atoms:
-            self.set_atom(a)
+    def set_index(self,container): # Set p_index
+        a_type, inverse = np.unique(np.array(container.a_type,dtype=str),return_inverse=True)
+        index = np.array([self.find_type(t) for t in a_type],dtype=int)
+        container.p_index[:] = index[inverse.reshape(-1)]
+        container.count_types()
         
         
     def pair(self,a,b,r2):
         if r2 > 0.00001:
-            r2 = self.sigma2[a.p_index,b.p_index] / r2
-            en = self.epsilon4[a.p_index,b.p_index] * (r2 ** 6 - r2 ** 3)
-            en += ELECTRIC_CONSTANT * a.charge * b.charge / r2 ** 0.5 # Energy conversion missing
-            return en
+            return float(self.pair_array(a.p_index,a.charge,b.p_index,b.charge,r2))
         else:
             return 0.0
+
+    def lj_array(self,p_a,p_b,r2):
+        r6 = 1.0 / (r2 * r2 * r2)
+        en = (self.c12[p_a,p_b] * r6 - self.c6[p_a,p_b]) * r6
+        if self.cutoff is not None:
+            if self.shift:
+                en = en - self.lj_shift[p_a,p_b]
+            en = np.where(r2 < self.cutoff2,en,0.0)
+        return en
+
+    def coulomb_array(self,q_a,q_b,r2):
+        if self.coulomb == 'wolf':
+            r = np.sqrt(r2)
+            en = ELECTRIC_CONSTANT * q_a * q_b * (erfc(self.alpha*r) / r - self.wolf_shift + self.wolf_force * (r - self.cutoff))
+        else:
+            en = ELECTRIC_CONSTANT * q_a * q_b / np.sqrt(r2)
+        if self.cutoff is not None:
+            en = np.where(r2 < self.cutoff2,en,0.0)
+        return en
+
+    def pair_array(self,p_a,q_a,p_b,q_b,r2):
+        '''Pair energy for arrays of type index, charge and squared distance, zero distance excluded'''
+        return self.lj_array(p_a,p_b,r2) + self.coulomb_array(q_a,q_b,r2)
         
-    def one_atom(self,atom, container):
+    def one_atom(self,atom, container, exclude = None):
+        occupancy = getattr(container,'occupancy',None)
+        if occupancy is not None and occupancy.has(atom.p_index) and occupancy.check(atom):
+            return math.inf
+        grid = getattr(container,'grid',None)
+        if grid is not None and grid.has(atom.p_index):
+            return grid.energy(atom)
+        return float(np.sum(self.one_atom_pairs(atom,container,exclude)[1]))
+
+    def one_atom_pairs(self,atom, container, exclude = None):
+        '''Index and energy of the particles of container interacting with atom, infinite energy on hard-core overlap'''
+        coord = (atom.x,atom.y,atom.z)
+        if container.cells is not None:
+            index = container.cells.candidates(coord)
+        else:
+            index = np.arange(len(container))
+        if self.kernel is not None:
+            if exclude is not None:
+                index = index[index != exclude]
+            energy = np.empty(len(index))
+            mask = np.empty(len(index),dtype=bool)
+            if self.kernel(np.array([coord]),container.pos[index],container.to_cartesian,container.to_internal,np.array([atom.p_index]),np.array([float(atom.charge)]),
+                           container.p_index[index],container.charge[index],*self.kernel_args,energy,mask):
+                return index[:0], np.array([math.inf])
+            return index[mask], energy[mask]
+        r2 = container.shortest_r2(coord,container.pos[index])
+        if exclude is not None:
+            r2[index == exclude] = 0.0
+        mask = r2 > 0.00001
+        if self.cutoff is not None:
+            mask &= r2 < self.cutoff2
+        index = index[mask]
+        r2 = r2[mask]
+        if self.core2 is not None and np.any(r2 < self.core2[atom.p_index,container.p_index[index]]):
+            return index[:0], np.array([math.inf])
+        return index, self.pair_array(atom.p_index,atom.charge,container.p_index[index],container.charge[index],r2)
+
+    def correction(self,atom,adsorbent,lattice = None,exclude = None):
+        '''Energy of inserting atom that does not depend on its position, exclude is its index when already in adsorbent'''
         en = 0.0
-        for x in container.atoms:
-            en += self.pair(atom, x, container.shortest_r2(atom,x))
-        return en # Did not count periodic
+        if self.coulomb == 'wolf':
+            en += self.wolf_self * atom.charge ** 2
+        if self.tail and self.cutoff is not None:
+            # The containers keep their type counts, nothing here depends on the number of particles
+            tail = self.tail_table[atom.p_index]
+            count = adsorbent.type_count
+            pair = np.dot(count,tail[:len(count)])
+            if exclude is not None:
+                pair -= tail[adsorbent.buffer_index[exclude]]
+            en += (2 * pair + tail[atom.p_index]) / adsorbent.volume
+            if lattice is not None:
+                count, frame = self.frame_tail
+                if count is not lattice.type_count: # count_types makes a new array when the framework changes
+                    count = lattice.type_count
+                    frame = 2 * np.dot(self.tail_table[:,:len(count)],count) / lattice.volume
+                    self.frame_tail = (count,frame)
+                en += frame[atom.p_index]
+        return float(en)
+
+    def many_atoms(self,coord,p_index,charge,container,chunk = 1000000,exclude = None):
+        '''Energy of each of the (k,3) positions with the container, type and charge are scalars or (k,) arrays'''
+        coord = np.reshape(coord,(-1,3))
+        grid = getattr(container,'grid',None)
+        if grid is not None and grid.has(p_index):
+            en = grid.energies(coord,p_index,charge)
+            occupancy = getattr(container,'occupancy',None)
+            if occupancy is not None and np.ndim(p_index) == 0 and occupancy.has(p_index):
+                en[occupancy.check_many(coord,p_index)] = math.inf
+            return en
+        if len(container) == 0:
+            return np.zeros(len(coord))
+        if np.ndim(p_index) == 0 and np.ndim(charge) == 0:
+            return self.type_atoms(coord,int(p_index),float(charge),container,chunk,exclude)
+        p_index = np.broadcast_to(p_index,len(coord))
+        charge = np.broadcast_to(charge,len(coord))
+        en = np.zeros(len(coord))
+        if container.cells is not None:
+            width = container.cells.table.shape[1] * 27
+        else:
+            width = len(container)
+        step = max(1,chunk//max(1,width))
+        for start in range(0,len(coord),step):
+            c = coord[start:start+step]
+            if container.cells is not None:
+                index = container.cells.candidates_many(c)
+            else:
+                index = np.broadcast_to(np.arange(len(container)),(len(c),len(container)))
+            d = container.minimum_image(container.pos[index] - c[:,None,:])
+            r2 = np.einsum('ijk,ijk->ij',d,d)
+            mask = (r2 > 0.00001) & (index >= 0)
+            if exclude is not None:
+                mask &= index != exclude
+            if self.cutoff is not None:
+                mask &= r2 < self.cutoff2
+            pairs = np.zeros(r2.shape)
+            row = np.nonzero(mask)[0] + start
+            col = index[mask]
+            pairs[mask] = self.pair_array(p_index[row],charge[row],container.p_index[col],container.charge[col],r2[mask])
+            en[start:start+step] = np.sum(pairs,axis=1)
+            if self.core2 is not None:
+                overlap = np.zeros(r2.shape,dtype=bool)
+                overlap[mask] = r2[mask] < self.core2[p_index[row],container.p_index[col]]
+                en[start:start+step][np.any(overlap,axis=1)] = math.inf
+        return en
         
+    def type_atoms(self,coord,p_index,charge,container,chunk = 1000000,exclude = None):
+        '''many_atoms for a single type and charge, the trial positions of the multiple-try moves and Widom'''
+        en = np.empty(len(coord))
+        exclude = -1 if exclude is None else exclude
+        if container.cells is not None:
+            width = container.cells.table.shape[1] * 27
+        else:
+            width = len(container)
+            index = np.arange(len(container))
+        step = max(1,chunk//max(1,width))
+        if self.trial_kernel is not None:
+            for start in range(0,len(coord),step):
+                c = coord[start:start+step]
+                if container.cells is not None:
+                    index = container.cells.candidates_many(c)
+                self.trial_kernel(np.ascontiguousarray(c),container.pos,np.reshape(index,(-1,width)),container.to_cartesian,container.to_internal,
+                                  p_index,charge,container.p_index,container.charge,exclude,*self.kernel_args,en[start:start+step])
+            return en
+        # Rows of the pair tables for this type, looked up by the type of the other particle
+        c12 = self.c12[p_index]
+        c6 = self.c6[p_index]
+        lj_shift = self.lj_shift[p_index]
+        core2 = self.core2[p_index] if self.core2 is not None else None
+        for start in range(0,len(coord),step):
+            c = coord[start:start+step]
+            if container.cells is not None:
+                # Flat list of the candidates, the slots of the cell table are mostly empty
+                index = container.cells.candidates_many(c)
+                row, col = np.nonzero((index >= 0) & (index != exclude))
+                index = index[row,col]
+                r2 = container.shortest_r2(c[row],container.pos[index])
+            else:
+                row = np.repeat(np.arange(len(c)),len(container))
+                index = np.tile(np.arange(len(container)),len(c))
+                d = container.minimum_image(container.pos[None,:,:] - c[:,None,:])
+                r2 = np.einsum('ijk,ijk->ij',d,d).ravel()
+                if exclude >= 0:
+                    r2[index == exclude] = 0.0
+            mask = r2 > 0.00001
+            if self.cutoff is not None:
+                mask &= r2 < self.cutoff2
+            row = row[mask]
+            index = index[mask]
+            r2 = r2[mask]
+            p_b = container.p_index[index]
+            r6 = 1.0 / (r2 * r2 * r2)
+            pairs = (c12[p_b] * r6 - c6[p_b]) * r6
+            if self.cutoff is not None and self.shift:
+                pairs -= lj_shift[p_b]
+            if charge != 0.0:
+                pairs += self.coulomb_array(charge,container.charge[index],r2)
+            en[start:start+step] = np.bincount(row,pairs,minlength=len(c))
+            if core2 is not None:
+                en[start:start+step][np.bincount(row,r2 < core2[p_b],minlength=len(c)) > 0] = math.inf
+        return en
+
+    def pairs(self,box):
+        '''Index arrays i, j and energy of every interacting pair in the container'''
+        if box.cells is not None:
+            i, j = box.cells.pairs()
+        else:
+            i, j = np.triu_indices(len(box),1)
+        if self.kernel is not None:
+            energy = np.empty(len(i))
+            mask = np.empty(len(i),dtype=bool)
+            self.kernel(box.pos[i],box.pos[j],box.to_cartesian,box.to_internal,box.p_index[i],box.charge[i],box.p_index[j],box.charge[j],*self.kernel_args,energy,mask)
+            return i[mask], j[mask], energy[mask]
+        d = box.minimum_image(box.pos[i] - box.pos[j])
+        r2 = np.einsum('ij,ij->i',d,d)
+        mask = r2 > 0.00001
+        if self.cutoff is not None:
+            mask &= r2 < self.cutoff2
+        i = i[mask]
+        j = j[mask]
+        return i, j, self.pair_array(box.p_index[i],box.charge[i],box.p_index[j],box.charge[j],r2[mask])
+
     def box(self,box):
-        en = 0.0
-        n = len(box.atoms)
-        for i in range(n-1):
-            for j in range(i+1,n):
-                en += self.pair(box.atoms[i], box.atoms[j], box.shortest_r2(box.atoms[i],box.atoms[j]))
-        return en # Did not count periodic
+        return float(np.sum(self.pairs(box)[2]))
+
+    def terms_array(self,p_a,q_a,p_b,q_b,r2):
+        '''(m,3) r**-12, r**-6 and r**-1 parts of each untruncated pair energy, they scale as k**-12, k**-6 and k**-1'''
+        r6 = 1.0 / (r2 * r2 * r2)
+        terms = np.empty((len(r2),3))
+        terms[:,0] = self.c12[p_a,p_b] * r6 * r6
+        terms[:,1] = -self.c6[p_a,p_b] * r6
+        terms[:,2] = ELECTRIC_CONSTANT * q_a * q_b / np.sqrt(r2)
+        return terms
+
+    def one_atom_terms(self,atom,container,exclude = None):
+        '''Index and terms of atom with every particle of container, only valid without cutoff'''
+        r2 = container.shortest_r2((atom.x,atom.y,atom.z),container.pos)
+        if exclude is not None:
+            r2[exclude] = 0.0
+        index = np.nonzero(r2 > 0.00001)[0]
+        return index, self.terms_array(atom.p_index,atom.charge,container.p_index[index],container.charge[index],r2[index])
+
+    def particle_terms(self,box):
+        '''(n,3) terms of each particle with all the others, only valid without cutoff'''
+        n = len(box)
+        i, j = np.triu_indices(n,1)
+        d = box.minimum_image(box.pos[i] - box.pos[j])
+        r2 = np.einsum('ij,ij->i',d,d)
+        mask = r2 > 0.00001
+        i = i[mask]
+        j = j[mask]
+        pair = self.terms_array(box.p_index[i],box.charge[i],box.p_index[j],box.charge[j],r2[mask])
+        terms = np.zeros((n,3))
+        for c in range(3):
+            terms[:,c] = np.bincount(i,pair[:,c],minlength=n) + np.bincount(j,pair[:,c],minlength=n)
+        return terms
 
     def interaction(self,adsorbent,lattice):
+        return float(np.sum(self.many_atoms(adsorbent.pos,adsorbent.p_index,adsorbent.charge,lattice)))
+
+    def particle_energies(self,container,lattice = None):
+        '''Energy of each particle with all the others and the lattice'''
+        n = len(container)
+        i, j, pair = self.pairs(container)
+        en = np.zeros(n)
+        en += np.bincount(i,pair,minlength=n)
+        en += np.bincount(j,pair,minlength=n)
+        if lattice is not None:
+            en += self.many_atoms(container.pos,container.p_index,container.charge,lattice)
+        return en
+
+    def correction_total(self,adsorbent,lattice = None):
+        '''Sum of the correction terms of every particle in adsorbent'''
         en = 0.0
-        for atom in adsorbent.atoms:
-            en += self.one_atom(atom,lattice)
+        if self.coulomb == 'wolf':
+            en += self.wolf_self * np.sum(adsorbent.charge ** 2)
+        if self.tail and self.cutoff is not None:
+            count = np.bincount(adsorbent.p_index,minlength=len(self.p_type))
+            en += np.dot(count,np.dot(self.tail_table,count)) / adsorbent.volume
+            if lattice is not None:
+                frame = np.bincount(lattice.p_index,minlength=len(self.p_type))
+                en += 2 * np.dot(count,np.dot(self.tail_table,frame)) / lattice.volume
+        return float(en)
+
+    def total(self,adsorbent,lattice = None):
+        en = self.box(adsorbent) + self.correction_total(adsorbent,lattice)
+        if lattice is not None:
+            en += self.interaction(adsorbent,lattice)
         return en
-        
-        
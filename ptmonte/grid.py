@@ -0,0 +1,172 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: grid
+'''
+
+import os
+import math
+import numpy as np
+from .cache import content_hash, save_directory
+from .cell import perpendicular_widths
+
+# Tabulated framework energy on a fractional grid over the unit cell
+class EnergyGrid:
+    def __init__(self):
+        self.spacing = 0.2 # Angstrom
+        self.energy_cap = 1e7 # Clip the energy inside the framework atoms
+        self.shape = (0,0,0)
+        self.p_index = [] # Adsorbate types present in the grid
+        self.types = frozenset() # The same types for the membership test of has
+        self.lj = None # (n_type, nx, ny, nz) Lennard-Jones energy
+        self.coulomb = None # (nx, ny, nz) potential for a unit charge
+        self.to_internal = None
+
+    def init(self, lattice, ff, p_index, spacing = 0.2, chunk = 2000000):
+        self.spacing = spacing
+        self.p_index = [int(p) for p in p_index]
+        self.types = frozenset(self.p_index)
+        # The grid covers the unit cell, the energy is summed over the whole supercell
+        self.to_internal = np.linalg.inv(lattice.unit_cell())
+        self.shape = tuple(max(1,int(math.ceil(length/spacing))) for length in np.array([lattice.a,lattice.b,lattice.c]) / lattice.counts)
+        nx, ny, nz = self.shape
+        # Framework atoms in fractional coordinate
+        frame = np.dot(lattice.pos,lattice.to_internal.T)
+        frame_index = lattice.p_index
+        frame_charge = lattice.charge
+        # Grid points in fractional coordinate of the supercell
+        points = np.stack(np.meshgrid(np.arange(nx)/nx,np.arange(ny)/ny,np.arange(nz)/nz,indexing='ij'),axis=-1).reshape(-1,3) / lattice.counts
+        lj = np.zeros((len(self.p_index),len(points)))
+        coulomb = np.zeros(len(points))
+        step = max(1,chunk//max(1,len(frame)))
+        for start in range(0,len(points),step):
+            d = points[start:start+step,None,:] - frame[None,:,:]
+            d -= np.round(d)
+            d = np.dot(d.reshape(-1,3),lattice.to_cartesian.T)
+            r2 = np.einsum('ij,ij->i',d,d).reshape(-1,len(frame))
+            r2 = np.maximum(r2,0.00001)
+            for k, p in enumerate(self.p_index):
+                lj[k,start:start+step] = np.sum(ff.lj_array(p,frame_index,r2),axis=1)
+            coulomb[start:start+step] = np.sum(ff.coulomb_array(1.0,frame_charge,r2),axis=1)
+        self.lj = np.minimum(lj,self.energy_cap).reshape((len(self.p_index),)+self.shape)
+        self.coulomb = np.clip(coulomb,-self.energy_cap,self.energy_cap).reshape(self.shape)
+
+    def has(self, p_index):
+        '''True when the grid holds the type p_index, or every type of an array of them'''
+        if np.ndim(p_index) == 0:
+            return int(p_index) in self.types
+        return self.types.issuperset(np.ravel(p_index).tolist())
+
+    def energies(self, coord, p_index, charge):
+        '''Trilinear interpolation of the framework energy for an (n,3) array of cartesian coordinate'''
+        n = np.array(self.shape)
+        f = np.dot(np.reshape(coord,(-1,3)),self.to_internal.T) * n
+        i0 = np.floor(f).astype(int)
+        w = f - i0
+        i0 %= n
+        i1 = (i0 + 1) % n
+        order = np.argsort(self.p_index)
+        k = order[np.searchsorted(self.p_index,p_index,sorter=order)]
+        lj = np.zeros(len(f))
+        coulomb = np.zeros(len(f))
+        for cx in (0,1):
+            wx = w[:,0] if cx else 1 - w[:,0]
+            ix = i1[:,0] if cx else i0[:,0]
+            for cy in (0,1):
+                wy = w[:,1] if cy else 1 - w[:,1]
+                iy = i1[:,1] if cy else i0[:,1]
+                for cz in (0,1):
+                    wz = w[:,2] if cz else 1 - w[:,2]
+                    iz = i1[:,2] if cz else i0[:,2]
+                    lj += wx * wy * wz * self.lj[k,ix,iy,iz]
+                    coulomb += wx * wy * wz * self.coulomb[ix,iy,iz]
+        return lj + charge * coulomb
+
+    def energy(self, atom):
+        return float(self.energies([atom.x,atom.y,atom.z],atom.p_index,atom.charge)[0])
+
+    def save(self, directory):
+        '''Write the grid as .npy files'''
+        os.makedirs(directory, exist_ok = True)
+        np.save(os.path.join(directory,'settings.npy'), [self.spacing,self.energy_cap])
+        np.save(os.path.join(directory,'p_index.npy'), np.array(self.p_index,dtype=int))
+        np.save(os.path.join(directory,'lj.npy'), self.lj)
+        np.save(os.path.join(directory,'coulomb.npy'), self.coulomb)
+        np.save(os.path.join(directory,'to_internal.npy'), self.to_internal)
+
+    def load(self, directory):
+        '''Read a grid written by save, the tables are memory-mapped read-only and shared by the processes'''
+        self.spacing, self.energy_cap = [float(x) for x in np.load(os.path.join(directory,'settings.npy'))]
+        self.p_index = [int(p) for p in np.load(os.path.join(directory,'p_index.npy'))]
+        self.types = frozenset(self.p_index)
+        self.lj = np.load(os.path.join(directory,'lj.npy'), mmap_mode = 'r')
+        self.coulomb = np.load(os.path.join(directory,'coulomb.npy'), mmap_mode = 'r')
+        self.to_internal = np.load(os.path.join(directory,'to_internal.npy'))
+        self.shape = self.coulomb.shape
+
+def cached_grid(directory, lattice_file, ff_file, lattice, ff, p_index, spacing = 0.2):
+    '''Load the grid of the framework from directory, build and save it if missing'''
+    key = content_hash(lattice_file, ff_file, extra = '{}:{}:{}:{}:{}:{}:{}'.format(sorted(p_index),spacing,ff.cutoff,ff.shift,ff.mixing,ff.coulomb,ff.alpha))
+    path = os.path.join(directory, key)
+    grid = EnergyGrid()
+    if os.path.isdir(path):
+        grid.load(path)
+    else:
+        grid.init(lattice, ff, p_index, spacing)
+        os.makedirs(directory, exist_ok = True)
+        save_directory(directory, key, grid.save)
+    return grid
+
+# Coarse map of the cells lying inside the hard core of a framework atom
+class OccupancyMap:
+    def __init__(self):
+        self.spacing = 0.5 # Angstrom
+        self.shape = (0,0,0)
+        self.p_index = []
+        self.blocked = None # (n_type, nx, ny, nz) boolean
+        self.to_internal = None
+
+    def init(self, lattice, ff, p_index, spacing = 0.5, chunk = 1000):
+        self.spacing = spacing
+        self.p_index = list(p_index)
+        # The map covers the unit cell, supercell stores its atoms first
+        unit = lattice.unit_cell()
+        self.to_internal = np.linalg.inv(unit)
+        self.shape = tuple(max(1,int(math.ceil(length/spacing))) for length in np.array([lattice.a,lattice.b,lattice.c]) / lattice.counts)
+        n = np.array(self.shape)
+        self.blocked = np.zeros((len(self.p_index),)+self.shape,dtype=bool)
+        # Largest distance from the centre of a cell to its corners
+        corner = np.array(np.meshgrid((-1,1),(-1,1),(-1,1),indexing='ij')).reshape(3,-1).T / (2 * n)
+        half_diagonal = np.max(np.linalg.norm(np.dot(corner,unit.T),axis=1))
+        n_unit = len(lattice) // lattice.n_cell
+        frame = np.dot(lattice.pos[:n_unit],self.to_internal.T)
+        for k, p in enumerate(self.p_index):
+            core = np.sqrt(ff.core2[p,lattice.p_index[:n_unit]])
+            # Cells around each atom covering the largest core
+            reach = np.ceil(core.max() * n / perpendicular_widths(unit)).astype(int)
+            offset = np.stack(np.meshgrid(*[np.arange(-r,r+1) for r in reach],indexing='ij'),axis=-1).reshape(-1,3)
+            for start in range(0,len(frame),chunk):
+                f = frame[start:start+chunk]
+                cell = np.floor(f * n).astype(int)[:,None,:] + offset[None,:,:]
+                d = (cell + 0.5) / n - f[:,None,:] # Cells are not wrapped yet, so d is the displacement itself
+                r = np.linalg.norm(np.dot(d,unit.T),axis=2)
+                inside = r + half_diagonal < core[start:start+chunk,None]
+                cell = cell[inside] % n
+                self.blocked[k,cell[:,0],cell[:,1],cell[:,2]] = True
+
+    def has(self, p_index):
+        return p_index in self.p_index
+
+    def check(self, atom):
+        '''True when atom lies in a cell fully inside the hard core of a framework atom'''
+        n = self.shape
+        f = np.dot(self.to_internal,(atom.x,atom.y,atom.z))
+        f -= np.floor(f)
+        return bool(self.blocked[self.p_index.index(atom.p_index),int(f[0]*n[0])%n[0],int(f[1]*n[1])%n[1],int(f[2]*n[2])%n[2]])
+
+    def check_many(self, coord, p_index):
+        n = np.array(self.shape)
+        f = np.dot(np.reshape(coord,(-1,3)),self.to_internal.T)
+        i = np.floor((f - np.floor(f)) * n).astype(int) % n
+        return self.blocked[self.p_index.index(p_index),i[:,0],i[:,1],i[:,2]]
@@ -0,0 +1,79 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: isotherm
+'''
+
+import copy
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from .simulation import GrandCanonicalSimulation
+
+# Framework shared by the simulations of one worker process
+_shared = {}
+
+def _init_worker(lattice, ff):
+    _shared['lattice'] = lattice
+    _shared['ff'] = ff
+
+def sample(simulation, n_equilibrate, n_production, target_error = None):
+    '''Run a simulation after its setup, return the row of the point, loading and energy per unit cell'''
+    if target_error is None:
+        simulation.tune()
+        simulation.run(n_equilibrate)
+        simulation.reset()
+        simulation.run(n_production)
+    else:
+        simulation.run_converged(target_error,max_step = n_production)
+    n_cell = simulation.lattice.n_cell # The simulated framework may be a supercell
+    row = {'temperature': simulation.temperature,
+           'pressure': simulation.pressure,
+           'loading': simulation.stat_adsorb.mean() / n_cell,
+           'loading_error': simulation.stat_adsorb.error() / n_cell,
+           'loading_inefficiency': simulation.stat_adsorb.inefficiency(),
+           'energy': simulation.stat_en.mean() / n_cell,
+           'energy_error': simulation.stat_en.error() / n_cell,
+           'n_cell': n_cell}
+    for step in simulation.steps:
+        row['accept_' + type(step).__name__[4:].lower()] = step.accept_rate() if step.total > 0 else np.nan
+    return row
+
+def _run_point(simulation, a_type, n_equilibrate, n_production, target_error, seed):
+    simulation.seed(seed)
+    simulation.setup(_shared['lattice'],_shared['ff'],a_type)
+    return sample(simulation,n_equilibrate,n_production,target_error)
+
+# Adsorption isotherm over a list of (temperature, pressure) points
+class Isotherm:
+    def __init__(self):
+        self.simulation = GrandCanonicalSimulation() # Template for the settings of every point
+        self.points = [] # (temperature, pressure)
+        self.n_equilibrate = 1000
+        self.n_production = 1000 # Upper bound of each stage when target_error is set
+        self.target_error = None # Stop each point once the loading per unit cell reaches this standard error
+        self.n_worker = None # Number of processes, all CPUs when None
+        self.seed = None
+        self.lattice = None
+        self.ff = None
+        self.a_type = ''
+
+    def init(self, lattice_file, ff_file, a_type, points = None):
+        if points is not None:
+            self.points = list(points)
+        self.a_type = a_type
+        self.lattice, self.ff = self.simulation.read(lattice_file,ff_file,a_type)
+
+    def run(self):
+        '''Run every point on a process pool, return a DataFrame with one row per point'''
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.points))
+        futures = []
+        with ProcessPoolExecutor(self.n_worker, initializer = _init_worker, initargs = (self.lattice,self.ff)) as pool:
+            for (temperature, pressure), seed in zip(self.points,seeds):
+                simulation = copy.deepcopy(self.simulation)
+                simulation.temperature = temperature
+                simulation.pressure = pressure
+                futures.append(pool.submit(_run_point,simulation,self.a_type,self.n_equilibrate,self.n_production,self.target_error,seed))
+            rows = [future.result() for future in futures]
+        return pd.DataFrame(rows)
@@ -0,0 +1,46 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: rng
+'''
+
+import bisect
+import numpy as np
+
+# Uniform numbers of a NumPy Generator drawn in blocks and handed out one by one
+class RandomStream:
+    def __init__(self, seed = None, block = 4096):
+        '''seed is an int, a SeedSequence or None for fresh entropy'''
+        if isinstance(seed,np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+        self.generator = np.random.Generator(np.random.PCG64(self.seed_sequence))
+        self.block = block
+        self.buffer = []
+        self.position = 0
+
+    def random(self):
+        '''Uniform number in [0, 1)'''
+        if self.position == len(self.buffer):
+            self.buffer = self.generator.random(self.block).tolist() # Python floats are faster to index
+            self.position = 0
+        x = self.buffer[self.position]
+        self.position += 1
+        return x
+
+    def randrange(self, n):
+        return int(self.random() * n)
+
+    def choice(self, cumulative):
+        '''Index drawn with the cumulative weights'''
+        return bisect.bisect_right(cumulative,self.random() * cumulative[-1])
+
+    def array(self, shape):
+        '''Block of uniform numbers taken from the generator directly'''
+        return self.generator.random(shape)
+
+    def spawn(self, n):
+        '''Independent streams for n workers'''
+        return [RandomStream(s,self.block) for s in self.seed_sequence.spawn(n)]
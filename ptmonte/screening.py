@@ -0,0 +1,228 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: screening
+'''
+
+import os
+import sys
+import copy
+import glob
+import json
+import math
+import time
+import signal
+import argparse
+import collections
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from .isotherm import sample
+from .simulation import GrandCanonicalSimulation
+
+# Frameworks read by one worker process, the arrays are memory-mapped from the cache directories
+_frameworks = collections.OrderedDict()
+N_CACHED = 4
+
+class JobTimeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise JobTimeout('Time limit of the job reached')
+
+def _framework(simulation, lattice_file, ff_file, a_type):
+    key = (lattice_file,ff_file,a_type)
+    if key in _frameworks:
+        _frameworks.move_to_end(key)
+    else:
+        _frameworks[key] = simulation.read(lattice_file,ff_file,a_type)
+        if len(_frameworks) > N_CACHED:
+            _frameworks.popitem(last = False)
+    return _frameworks[key]
+
+def _run_job(simulation, lattice_file, ff_file, a_type, n_equilibrate, n_production, target_error, seed, timeout):
+    '''One framework at one state point in a worker, the time limit is raised inside the job'''
+    start = time.perf_counter()
+    limit = timeout is not None and hasattr(signal,'SIGALRM')
+    if limit:
+        signal.signal(signal.SIGALRM,_alarm)
+        signal.setitimer(signal.ITIMER_REAL,timeout)
+    try:
+        lattice, ff = _framework(simulation,lattice_file,ff_file,a_type)
+        simulation.seed(seed)
+        simulation.setup(lattice,ff,a_type)
+        row = sample(simulation,n_equilibrate,n_production,target_error)
+    finally:
+        if limit:
+            signal.setitimer(signal.ITIMER_REAL,0)
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+def _clean(value):
+    '''JSON value of a result, NaN becomes null'''
+    if isinstance(value,(np.floating,float)):
+        return None if math.isnan(value) else float(value)
+    if isinstance(value,np.integer):
+        return int(value)
+    return value
+
+# Screening of many frameworks over a list of (temperature, pressure) points
+class Screening:
+    def __init__(self):
+        self.simulation = GrandCanonicalSimulation() # Template for the settings of every job
+        self.simulation.framework_dir = 'cache/framework'
+        self.simulation.grid_dir = 'cache/grid'
+        self.lattice_files = []
+        self.ff_file = ''
+        self.a_type = ''
+        self.points = [] # (temperature, pressure)
+        self.n_equilibrate = 1000
+        self.n_production = 1000 # Upper bound of each stage when target_error is set
+        self.target_error = None
+        self.n_worker = None # Number of processes, all CPUs when None
+        self.n_pending = 2 # Jobs queued per worker, an idle worker takes the next one
+        self.timeout = None # Seconds of one job
+        self.max_attempt = 3
+        self.result_file = 'screening.jsonl'
+        self.seed = None
+
+    def init(self, lattice_dir, ff_file, a_type, points = None):
+        self.lattice_files = sorted(glob.glob(os.path.join(lattice_dir,'*.cif')))
+        self.ff_file = ff_file
+        self.a_type = a_type
+        if points is not None:
+            self.points = list(points)
+
+    def jobs(self):
+        '''(framework, temperature, pressure, seed) of every job, one framework after another'''
+        seeds = np.random.SeedSequence(self.seed).spawn(len(self.lattice_files) * len(self.points))
+        result = []
+        for lattice_file in self.lattice_files:
+            for temperature, pressure in self.points:
+                result.append((lattice_file,temperature,pressure,seeds[len(result)]))
+        return result
+
+    def finished(self):
+        '''Jobs of the result file that succeeded, they are skipped on a restart'''
+        done = set()
+        if os.path.exists(self.result_file):
+            with open(self.result_file) as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue # Line cut by a crash
+                    if row.get('status') == 'ok':
+                        done.add((row['framework'],row['temperature'],row['pressure']))
+        return done
+
+    def submit(self, pool, job):
+        lattice_file, temperature, pressure, seed = job
+        simulation = copy.deepcopy(self.simulation)
+        simulation.temperature = temperature
+        simulation.pressure = pressure
+        return pool.submit(_run_job,simulation,lattice_file,self.ff_file,self.a_type,
+                           self.n_equilibrate,self.n_production,self.target_error,seed,self.timeout)
+
+    def run(self):
+        '''Run every job on a process pool, append one JSON line per job to the result file as it finishes
+        Return the number of successful and failed jobs'''
+        for directory in (self.simulation.framework_dir,self.simulation.grid_dir):
+            if directory is not None:
+                os.makedirs(directory,exist_ok = True)
+        done = self.finished()
+        queue = collections.deque(job for job in self.jobs() if (job[0],job[1],job[2]) not in done)
+        attempt = collections.Counter()
+        n_ok = n_failed = 0
+        n_worker = self.n_worker or os.cpu_count() or 1
+        with open(self.result_file,'a') as output:
+            def write(job, status, row):
+                row = dict(row,framework = job[0],temperature = job[1],pressure = job[2],
+                           status = status,attempt = attempt[job[0],job[1],job[2]])
+                output.write(json.dumps({k: _clean(v) for k, v in row.items()}) + '\n')
+                output.flush()
+            def failed(job, error):
+                key = (job[0],job[1],job[2])
+                if attempt[key] < self.max_attempt:
+                    queue.append(job) # Retried after the other jobs
+                    return 0
+                write(job,'failed',{'error': error})
+                return 1
+            while queue:
+                running = {}
+                pool = ProcessPoolExecutor(n_worker)
+                try:
+                    while queue or running:
+                        while queue and len(running) < self.n_pending * n_worker:
+                            job = queue.popleft()
+                            attempt[job[0],job[1],job[2]] += 1
+                            running[self.submit(pool,job)] = job
+                        finished, _ = wait(running,return_when = FIRST_COMPLETED)
+                        for future in finished:
+                            try:
+                                row = future.result()
+                            except BrokenProcessPool:
+                                raise
+                            except Exception as e:
+                                n_failed += failed(running.pop(future),'{}: {}'.format(type(e).__name__,e))
+                            else:
+                                write(running.pop(future),'ok',row)
+                                n_ok += 1
+                except BrokenProcessPool:
+                    # A worker died, every job of the pool is retried on a new one
+                    for job in running.values():
+                        n_failed += failed(job,'BrokenProcessPool: a worker process died')
+                    running = {}
+                finally:
+                    pool.shutdown(wait = False,cancel_futures = True)
+        return n_ok, n_failed
+
+def read_points(text):
+    '''State points from "T:P,T:P,..." in K and Pa'''
+    points = []
+    for item in text.split(','):
+        temperature, pressure = item.split(':')
+        points.append((float(temperature),float(pressure)))
+    return points
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Grand canonical screening of a directory of frameworks')
+    parser.add_argument('lattice_dir', help = 'directory of the CIF files')
+    parser.add_argument('ff_file', help = 'RASPA force field definition')
+    parser.add_argument('a_type', help = 'adsorbate type')
+    parser.add_argument('--points', type = read_points, required = True, help = 'state points T:P,T:P,... in K and Pa')
+    parser.add_argument('--output', default = 'screening.jsonl', help = 'JSON lines result file, finished jobs are skipped')
+    parser.add_argument('--cache', default = 'cache', help = 'directory of the memory-mapped framework and grid files')
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--timeout', type = float, default = None, help = 'seconds of one job')
+    parser.add_argument('--attempts', type = int, default = 3)
+    parser.add_argument('--equilibrate', type = int, default = 1000)
+    parser.add_argument('--production', type = int, default = 1000)
+    parser.add_argument('--target-error', type = float, default = None, help = 'standard error of the loading per unit cell')
+    parser.add_argument('--cutoff', type = float, default = 12.0)
+    parser.add_argument('--grid-spacing', type = float, default = None)
+    parser.add_argument('--mass', type = float, default = 16.0)
+    parser.add_argument('--seed', type = int, default = None)
+    args = parser.parse_args(argv)
+    screening = Screening()
+    screening.simulation.cutoff = args.cutoff
+    screening.simulation.grid_spacing = args.grid_spacing
+    screening.simulation.mass = args.mass
+    screening.simulation.framework_dir = os.path.join(args.cache,'framework')
+    screening.simulation.grid_dir = os.path.join(args.cache,'grid')
+    screening.n_worker = args.workers
+    screening.timeout = args.timeout
+    screening.max_attempt = args.attempts
+    screening.n_equilibrate = args.equilibrate
+    screening.n_production = args.production
+    screening.target_error = args.target_error
+    screening.result_file = args.output
+    screening.seed = args.seed
+    screening.init(args.lattice_dir,args.ff_file,args.a_type,args.points)
+    n_ok, n_failed = screening.run()
+    sys.stderr.write('{} jobs finished, {} failed\n'.format(n_ok,n_failed))
+    return 1 if n_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
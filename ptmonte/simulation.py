@@ -5,13 +5,25 @@ Last modified: 2017
 File: simulation
 '''
 
+import os
+import csv
+import itertools
 import math
+import time
+import copy
+import pickle
 import numpy as np
-import random
+import warnings
 from .atom import Atom
 from .structure import Lattice,Adsorbent,Box
-from .step import StepTranslation, StepAdd, StepRemove
+from .step import StepTranslation, StepAdd, StepRemove, StepVolume, StepSwap
+from .constants import *
 from .forcefield import ForceField
+from .grid import cached_grid, OccupancyMap
+from .cache import cached_lattice
+from .cell import perpendicular_widths
+from .statistics import BlockAverage
+from .rng import RandomStream
 
 class Simulation:
     def __init__(self):
@@ -19,33 +31,241 @@ class Simulation:
         self.adsorbent = None
         self.box = None
         self.ff = None
+        self.ff_box = None # ForceField of the box when it differs from ff
         self.record_en = []
         self.record_adsorb = []
+        self.keep_records = False # Keep every energy and loading in record_en / record_adsorb
+        self.stat_en = BlockAverage()
+        self.stat_adsorb = BlockAverage()
         self.steps = []
         self.p_step = []
+        self.cumulative = [] # Cumulative weights of p_step, rebuilt when p_step changes
+        self.cumulative_of = None
+        self.rng = RandomStream() # Shared by the steps, see seed
+        self.energy = 0.0 # Running total energy
+        self.n_step = 0
+        self.check_interval = 0 # Recompute the energy from scratch every check_interval steps, 0 to disable
+        self.drift_tolerance = 1e-6 # Relative drift reported as a warning
+        self.record_drift = []
+        self.trajectory = None # TrajectoryWriter of the adsorbent
+        self.checkpoint_file = None
+        self.checkpoint_interval = 0 # Steps between two checkpoints, 0 to disable
+        self.target_acceptance = 0.5 # Acceptance aimed at by calibrate
+        self.n_calibrate = 0 # Calibration steps before the equilibration of run_converged
+        self.n_schedule = 0 # Steps spent choosing p_step before the equilibration of run_converged
+        self.p_min = 0.05 # Smallest weight of a group of moves in the schedule
+        self.step_groups = None # Index of the steps sharing one weight in the schedule, every step alone when None
+        self.record_schedule = [] # (p_step, statistical inefficiency of the loading, cost of each step) of every trial mix
+        self.record_calibration = [] # (n_step, step, p_index, acceptance, d_max) of every adjustment
         
     def init(self):
         pass
+
+    def seed(self,seed = None):
+        '''Start a new random stream from an int or a SeedSequence, spawn the SeedSequence for parallel workers'''
+        self.rng = RandomStream(seed)
+        for step in self.steps:
+            step.rng = self.rng
         
     def single_run(self): # Change this function if you want to record the potential
-        r = random.choices(range(len(self.steps)),self.p_step)[0]
-        self.steps[r].run(lattice = self.lattice,adsorbent = self.adsorbent, box = self.box)
+        self.move()
+        self.post_step()
+
+    def move(self):
+        '''Run one step chosen from p_step and update the running total'''
+        if self.cumulative_of != self.p_step:
+            self.cumulative_of = list(self.p_step)
+            self.cumulative = list(itertools.accumulate(self.p_step))
+        r = self.rng.choice(self.cumulative)
+        step = self.steps[r]
+        start = time.perf_counter()
+        self.energy += step.run(lattice = self.lattice,adsorbent = self.adsorbent, box = self.box)
+        step.time += time.perf_counter() - start
+        step.calls += 1
+        self.n_step += 1
+        if self.check_interval > 0 and self.n_step % self.check_interval == 0:
+            drift = self.recompute()
+            self.record_drift.append(drift)
+            if abs(drift) > self.drift_tolerance * max(1.0,abs(self.energy)):
+                warnings.warn('Energy drift of {} K after {} steps'.format(drift,self.n_step))
+
+    def post_step(self):
+        '''Write the trajectory and the checkpoint once the step is recorded, so a restart resumes exactly'''
+        if self.trajectory is not None and self.n_step % self.trajectory.stride == 0:
+            self.trajectory.append(self.n_step,self.energy,self.box if self.adsorbent is None else self.adsorbent)
+        if self.checkpoint_interval > 0 and self.n_step % self.checkpoint_interval == 0:
+            self.save_checkpoint(self.checkpoint_file)
+
+    def recompute(self):
+        '''Recompute the particle energies and the total from scratch, return the drift of the running total'''
+        energy = 0.0
+        if self.adsorbent is not None:
+            self.adsorbent.energy[:] = self.ff.particle_energies(self.adsorbent,self.lattice)
+            energy += self.ff.total(self.adsorbent,self.lattice)
+        if self.box is not None:
+            ff = self.ff_box or self.ff
+            self.box.energy[:] = ff.particle_energies(self.box)
+            energy += ff.total(self.box)
+            if ff.cutoff is None:
+                self.box.particle_terms[:] = ff.particle_terms(self.box)
+                self.box.terms = self.box.particle_terms.sum(axis=0) / 2
+        drift = self.energy - energy
+        self.energy = energy
+        return drift
         
     def run(self,n_step):
         for i in range(n_step):
             self.single_run()
             
-    def calibrate(self,n_step):
-        pass
+    def calibrate(self,n_step,n_block = 200):
+        '''Tune the move sizes toward target_acceptance every n_block steps, they stay frozen afterward'''
+        container = self.adsorbent if self.box is None else self.box
+        d_limit = float(np.min(perpendicular_widths(container.to_cartesian)))
+        for start in range(0,n_step,n_block):
+            for step in self.steps:
+                step.reset()
+            self.run(min(n_block,n_step-start))
+            for k, step in enumerate(self.steps):
+                if not hasattr(step,'adjust'):
+                    continue
+                for p, (rate, d_max) in step.adjust(self.target_acceptance,d_limit).items():
+                    self.record_calibration.append((self.n_step,k,p,rate,d_max))
+        for step in self.steps:
+            step.reset()
+        return self.record_calibration
     
+    def schedule(self,n_step,n_block = 5000):
+        '''Search the p_step giving the most independent loading samples per second, it stays frozen afterward'''
+        groups = self.step_groups or [[k] for k in range(len(self.steps))]
+        # Moves of a group keep equal weights, insertion and deletion must stay balanced
+        best = np.array([sum(self.p_step[k] for k in group) for group in groups],dtype=float)
+        best /= best.sum()
+        measured = {} # Inefficiencies of every mix already run, keyed by its rounded weights
+        time_step = np.zeros(len(self.steps)) # Time and calls of each step pooled over all the mixes
+        calls = np.zeros(len(self.steps))
+        def measure(w):
+            measured.setdefault(tuple(np.round(w,6)),[]).append(self.measure_mix(self.group_weights(groups,w),n_block))
+            time_step[:] += [step.time for step in self.steps]
+            calls[:] += [step.calls for step in self.steps]
+            return n_block
+        def score(w):
+            # Seconds per step come from the pooled costs, only the inefficiency is specific to the mix
+            cost = np.dot(self.group_weights(groups,w),time_step / np.maximum(calls,1))
+            return 1.0 / (np.mean(measured[tuple(np.round(w,6))]) * cost)
+        n = 0
+        while n < min(2,n_step // n_block) * n_block:
+            n += measure(best)
+        while n + n_block <= n_step:
+            improved = False
+            for g in range(len(groups)):
+                for factor in (2.0,0.5):
+                    w = best.copy()
+                    w[g] *= factor
+                    w /= w.sum()
+                    low = w < self.p_min # Raise these to p_min and take it from the others
+                    w[low] = self.p_min
+                    w[~low] *= (1.0 - self.p_min * np.sum(low)) / np.sum(w[~low])
+                    if tuple(np.round(w,6)) in measured:
+                        continue # With two groups raising one is lowering the other
+                    if n + n_block > n_step:
+                        break
+                    n += measure(w)
+                    if score(w) > score(best) and n + n_block <= n_step:
+                        n += measure(w) # A single noisy run does not replace the best mix
+                    if score(w) > score(best):
+                        best = w
+                        improved = True
+            if not improved:
+                break
+        self.p_step = self.group_weights(groups,best)
+        for step in self.steps:
+            step.reset()
+        return self.record_schedule
+
+    def measure_mix(self,p_step,n_step):
+        '''Run n_step steps with p_step, return the statistical inefficiency of the loading'''
+        self.p_step = list(p_step)
+        for step in self.steps:
+            step.reset()
+        loading = BlockAverage(min_blocks = 16)
+        for i in range(n_step):
+            Simulation.single_run(self)
+            loading.add(len(self.adsorbent))
+        inefficiency = loading.inefficiency()
+        if math.isnan(inefficiency):
+            inefficiency = float(n_step) # No plateau or a frozen loading, at most one independent sample
+        inefficiency = max(1.0,inefficiency)
+        self.record_schedule.append((list(p_step),inefficiency,[step.cost() for step in self.steps]))
+        return inefficiency
+
+    def group_weights(self,groups,weights):
+        p_step = [0.0] * len(self.steps)
+        for group, w in zip(groups,weights):
+            for k in group:
+                p_step[k] = float(w) / len(group)
+        return p_step
+
+    def tune(self):
+        '''Calibrate the move sizes then the move mix, as set by n_calibrate and n_schedule'''
+        if self.n_calibrate > 0:
+            self.calibrate(self.n_calibrate)
+        if self.n_schedule > 0:
+            self.schedule(self.n_schedule)
+
     def reset(self):
         for step in self.steps:
             step.reset()
         self.record_en = []
         self.record_adsorb = []
+        self.stat_en.reset()
+        self.stat_adsorb.reset()
             
-    def to_csv(self):
-        pass
+    def to_csv(self,file_name):
+        '''Write the recorded energy and loading of every step, needs keep_records'''
+        with open(file_name,'w',newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['energy','loading'])
+            writer.writerows(zip(self.record_en,self.record_adsorb))
+
+    def save_checkpoint(self,file_name):
+        '''Save everything that changes during the run, the lattice and force field are read again on restart'''
+        state = {'adsorbent': self.adsorbent, 'box': self.box, 'energy': self.energy, 'n_step': self.n_step,
+                 'record_en': self.record_en, 'record_adsorb': self.record_adsorb, 'record_drift': self.record_drift,
+                 'stat_en': self.stat_en, 'stat_adsorb': self.stat_adsorb, 'record_calibration': self.record_calibration,
+                 'p_step': self.p_step, 'record_schedule': self.record_schedule,
+                 'steps': [{k: v for k, v in step.__dict__.items() if k not in ('ff','ff_box')} for step in self.steps],
+                 'rng': self.rng, 'trajectory': None}
+        if self.trajectory is not None:
+            state['trajectory'] = self.trajectory.flush()
+        temp = '{}.{}.tmp'.format(file_name,os.getpid())
+        with open(temp,'wb') as f:
+            pickle.dump(state,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp,file_name) # A crash never leaves a partial checkpoint
+
+    def load_checkpoint(self,file_name):
+        '''Resume a simulation set up with the same settings, the trajectory is cut back to the checkpoint'''
+        with open(file_name,'rb') as f:
+            state = pickle.load(f)
+        self.adsorbent = state['adsorbent']
+        self.box = state['box']
+        self.energy = state['energy']
+        self.n_step = state['n_step']
+        self.record_en = state['record_en']
+        self.record_adsorb = state['record_adsorb']
+        self.record_drift = state['record_drift']
+        self.stat_en = state['stat_en']
+        self.stat_adsorb = state['stat_adsorb']
+        self.record_calibration = state['record_calibration']
+        self.p_step = state['p_step']
+        self.record_schedule = state['record_schedule']
+        for step, saved in zip(self.steps,state['steps']):
+            step.__dict__.update(saved)
+        self.rng = state['rng']
+        for step in self.steps:
+            step.rng = self.rng
+        if self.trajectory is not None and state['trajectory'] is not None:
+            self.trajectory.close()
+            self.trajectory.init(self.trajectory.file_name,self.trajectory.stride,self.trajectory.chunk,state['trajectory'])
 
 
 class GrandCanonicalSimulation(Simulation):
@@ -56,26 +276,70 @@ class GrandCanonicalSimulation(Simulation):
         self.d_max = 1.0
         self.mass = 16.0
         self.p_step = [0.4,0.3,0.3]
-        
+        self.step_groups = [[0],[1,2]] # Insertion and deletion are chosen equally often
+        self.grid_spacing = None # Angstrom, tabulate the framework energy when set
+        self.grid_dir = 'grid'
+        self.framework_dir = None # Directory caching the expanded framework, CIF is parsed every time when None
+        self.cutoff = None # Angstrom, use cell lists when set
+        self.coulomb = 'bare' # 'wolf' for damped shifted force electrostatics
+        self.alpha = 0.2 # Wolf damping in 1/Angstrom
+        self.core_factor = None # Reject trials closer than core_factor * sigma to any atom
+        self.backend = 'auto' # Energy kernels, 'numpy', 'numba' or 'auto'
+        self.k_trial = 1 # Trial positions of each insertion and deletion, Rosenbluth weighted when more than 1
+        self.k_translation = 1 # Displacements of each multiple-try translation
+        self.occupancy_spacing = 0.5 # Angstrom, cells of the framework hard-core map
         
     def init(self,lattice_file,ff_file,a_type):
-        # Prepare the lattice
-        self.lattice = Lattice()
-        self.lattice.read_cif(lattice_file)
-        self.lattice.init()
+        lattice, ff = self.read(lattice_file,ff_file,a_type)
+        self.setup(lattice,ff,a_type)
+
+    def read(self,lattice_file,ff_file,a_type):
+        '''Prepare the lattice and force field, they are only read by the simulation and can be shared'''
         # Prepare the force field
-        self.ff = ForceField()
-        self.ff.read_raspa_def(ff_file)
-        self.ff.init()
+        ff = ForceField()
+        ff.read_raspa_def(ff_file)
+        ff.cutoff = self.cutoff
+        ff.coulomb = self.coulomb
+        ff.alpha = self.alpha
+        ff.core_factor = self.core_factor
+        ff.backend = self.backend
+        ff.init()
+        # Prepare the lattice with its index
+        if self.framework_dir is not None:
+            lattice = cached_lattice(self.framework_dir,lattice_file,ff_file,ff,cutoff = self.cutoff)
+        else:
+            lattice = Lattice()
+            lattice.read_cif(lattice_file)
+            lattice.init()
+            ff.set_index(lattice)
+            if self.cutoff is not None:
+                lattice.supercell(self.cutoff)
+        if self.cutoff is not None:
+            lattice.init_cells(self.cutoff)
+        atom = Atom()
+        atom.a_type = a_type
+        ff.set_atom(atom)
+        if self.grid_spacing is not None:
+            lattice.grid = cached_grid(self.grid_dir,lattice_file,ff_file,lattice,ff,[atom.p_index],self.grid_spacing)
+        if self.core_factor is not None:
+            lattice.occupancy = OccupancyMap()
+            lattice.occupancy.init(lattice,ff,[atom.p_index],self.occupancy_spacing)
+        return lattice, ff
+
+    def setup(self,lattice,ff,a_type):
+        self.lattice = lattice
+        self.ff = ff
         # Generate the adsorbent
         self.adsorbent = Adsorbent()
         self.adsorbent.copy_lattice(self.lattice)
-        # Set index for the lattice
-        self.ff.set_index(self.lattice)
+        if self.ff.cutoff is not None:
+            self.adsorbent.init_cells(self.ff.cutoff)
         # Add translation step
+        self.steps = []
         a = StepTranslation()
         a.ff = self.ff
         a.init(self.d_max,self.temperature)
+        a.k_trial = self.k_translation
         self.steps.append(a)
         # Add addition step
         atom = Atom()
@@ -84,26 +348,117 @@ class GrandCanonicalSimulation(Simulation):
         a = StepAdd()
         a.ff = self.ff
         a.init(atom,self.mass,self.pressure,self.temperature)
+        a.k_trial = self.k_trial
         self.steps.append(a)
         a = StepRemove()
         a.ff = self.ff
         a.init(self.mass,self.pressure,self.temperature)
+        a.k_trial = self.k_trial
         self.steps.append(a)
+        for step in self.steps:
+            step.rng = self.rng
+        self.recompute()
         
     def single_run(self):
-        Simulation.single_run(self)
-        # self.record_en.append(self.ff.interaction(self.adsorbent,self.lattice)+self.ff.box(self.adsorbent) )
-        self.record_adsorb.append(len(self.adsorbent.atoms))
+        self.move()
+        self.stat_en.add(self.energy)
+        self.stat_adsorb.add(len(self.adsorbent))
+        if self.keep_records:
+            self.record_en.append(self.energy)
+            self.record_adsorb.append(len(self.adsorbent))
+        self.post_step()
+
+    def equilibrate(self, n_block = 1000, window = 5, max_step = 10**7):
+        '''Run blocks of n_block steps until the loading stops drifting, return the number of steps'''
+        means = []
+        n = 0
+        while n < max_step:
+            block = BlockAverage()
+            for i in range(n_block):
+                Simulation.single_run(self)
+                block.add(len(self.adsorbent))
+            n += n_block
+            means.append(block.mean())
+            if len(means) >= 2 * window:
+                old = means[-2*window:-window]
+                new = means[-window:]
+                spread = (np.var(old,ddof=1) + np.var(new,ddof=1)) / window
+                # Equilibrated when the two windows agree within two standard errors
+                if abs(np.mean(new) - np.mean(old)) <= 2 * math.sqrt(spread):
+                    break
+                means = means[-2*window:]
+        return n
+
+    def run_converged(self, target_error, n_block = 1000, max_step = 10**7):
+        '''Tune and equilibrate, then run until the standard error of the loading per unit cell reaches target_error, return the production steps'''
+        self.tune()
+        self.equilibrate(n_block,max_step = max_step)
+        self.reset()
+        target = target_error * self.lattice.n_cell # stat_adsorb counts the particles of the whole supercell
+        n = 0
+        while n < max_step:
+            self.run(n_block)
+            n += n_block
+            if self.stat_adsorb.error() <= target: # nan until the blocking reaches a plateau
+                break
+        return n
     
-class GibbsEnsembleSimulation(Simulation):
+# Adsorbent in equilibrium with a bulk box at constant pressure, the particles are swapped between them
+class GibbsEnsembleSimulation(GrandCanonicalSimulation):
     def __init__(self):
-        Simulation.__init__(self)
-        self.temperature = 273.15
-        self.pressure = 1.0
-        self.d_max = 1.0
+        GrandCanonicalSimulation.__init__(self)
         self.d_logV = 0.1
-        self.mass = 1.0
-        self.p_step = []
-        
-    def init(self, lattice_file, ff_file, a_type):
-        pass
+        self.n_particle = 100 # Particles of the box at the start
+        self.p_step = [0.3,0.3,0.1,0.3] # Translation in the adsorbent and the box, volume, swap
+        self.step_groups = None
+
+    def setup(self,lattice,ff,a_type):
+        self.lattice = lattice
+        self.ff = ff
+        # The box has no cutoff, so a volume move only rescales the r**-12, r**-6 and r**-1 sums
+        # Both phases model the same fluid only when the cut potential of the adsorbent is completed by the tail
+        if ff.cutoff is not None and (ff.shift or not ff.tail):
+            raise ValueError('Gibbs ensemble needs the unshifted Lennard-Jones with tail correction when a cutoff is set')
+        if ff.coulomb != 'bare':
+            raise ValueError('Gibbs ensemble needs bare Coulomb, the box has no Wolf summation')
+        self.ff_box = copy.copy(ff)
+        self.ff_box.cutoff = None
+        self.ff_box.tail = False # Nothing is cut in the box
+        self.ff_box.init()
+        self.adsorbent = Adsorbent()
+        self.adsorbent.copy_lattice(self.lattice)
+        if self.ff.cutoff is not None:
+            self.adsorbent.init_cells(self.ff.cutoff)
+        # Ideal gas box at the pressure
+        atom = Atom()
+        atom.a_type = a_type
+        self.ff.set_atom(atom)
+        self.box = Box()
+        self.box.init((self.n_particle * BOLTZMANN_ANGSTROM * self.temperature / self.pressure) ** (1/3),self.n_particle)
+        while len(self.box) < self.n_particle:
+            atom.x, atom.y, atom.z = self.rng.array(3) * self.box.side
+            if self.ff_box.one_atom(atom,self.box) <= 0.0: # No overlap at the start
+                self.box.append(atom)
+        self.steps = []
+        a = StepTranslation()
+        a.ff = self.ff
+        a.init(self.d_max,self.temperature)
+        a.k_trial = self.k_translation
+        self.steps.append(a)
+        a = StepTranslation()
+        a.ff = self.ff_box
+        a.init(self.d_max,self.temperature,in_box = True)
+        a.k_trial = self.k_translation
+        self.steps.append(a)
+        a = StepVolume()
+        a.ff = self.ff_box
+        a.init(self.pressure,self.d_logV,self.temperature)
+        self.steps.append(a)
+        a = StepSwap()
+        a.ff = self.ff
+        a.ff_box = self.ff_box
+        a.init(self.temperature)
+        self.steps.append(a)
+        for step in self.steps:
+            step.rng = self.rng
+        self.recompute()
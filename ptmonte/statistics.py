@@ -0,0 +1,82 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: statistics
+'''
+
+import math
+
+# Mean and correlated standard error of a series in constant memory
+# Welford update on each level of the blocking transformation of Flyvbjerg and Petersen
+class BlockAverage:
+    def __init__(self, min_blocks = 32):
+        self.min_blocks = min_blocks # Levels with fewer blocks are too noisy for the error
+        self.count = [] # Number of blocks of 2**level samples
+        self.average = []
+        self.m2 = [] # Sum of the squared deviations
+        self.pending = [] # First half of the next block, None when empty
+
+    def add(self, x):
+        level = 0
+        while True:
+            if level == len(self.count):
+                self.count.append(0)
+                self.average.append(0.0)
+                self.m2.append(0.0)
+                self.pending.append(None)
+            self.count[level] += 1
+            delta = x - self.average[level]
+            self.average[level] += delta / self.count[level]
+            self.m2[level] += delta * (x - self.average[level])
+            if self.pending[level] is None:
+                self.pending[level] = x
+                return
+            x = (self.pending[level] + x) / 2
+            self.pending[level] = None
+            level += 1
+
+    def __len__(self):
+        return self.count[0] if self.count else 0
+
+    def mean(self):
+        return self.average[0] if self.count else math.nan
+
+    def variance(self):
+        if len(self) < 2:
+            return math.nan
+        return self.m2[0] / (self.count[0] - 1)
+
+    def errors(self):
+        '''Standard error of the mean estimated on every level with enough blocks'''
+        return [math.sqrt(m2 / (count - 1) / count) for count, m2 in zip(self.count,self.m2) if count >= max(2,self.min_blocks)]
+
+    def plateau(self):
+        '''True when the error stops growing over the last three levels, within twice their own uncertainty'''
+        errors = self.errors()
+        if len(errors) < 3:
+            return False
+        count = [c for c in self.count if c >= max(2,self.min_blocks)]
+        # Relative uncertainty of a blocking error estimated from n blocks is 1/sqrt(2(n-1))
+        sigma = [e / math.sqrt(2 * (n - 1)) for e, n in zip(errors,count)]
+        return errors[-1] - errors[-3] <= 2 * math.hypot(sigma[-1],sigma[-3])
+
+    def error(self):
+        '''Standard error at the plateau of the blocking, the largest estimate is taken
+        nan before the plateau, when the correlation is still longer than the blocks'''
+        if not self.plateau():
+            return math.nan
+        return max(self.errors())
+
+    def inefficiency(self):
+        '''Statistical inefficiency, number of steps per independent sample'''
+        variance = self.variance()
+        if not variance > 0:
+            return math.nan
+        return len(self) * self.error() ** 2 / variance
+
+    def reset(self):
+        self.count = []
+        self.average = []
+        self.m2 = []
+        self.pending = []
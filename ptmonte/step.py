@@ -5,7 +5,7 @@ Last modified: 2017
 File: step
 '''
 
-import random
+import time
 import numpy as np
 import math
 from .atom import Atom
@@ -18,56 +18,202 @@ class Step:
         self.total = 0
         self.temperature = 275.15
         self.ff = None # Reference to ForceField
+        self.rng = None # Reference to the RandomStream of the simulation
+        self.overlap = 0 # Trials rejected by the hard-core pre-screen
+        self.time_overlap = 0.0 # Time spent on these trials
+        self.time_full = 0.0 # Time spent on the trials scored in full
+        self.n_full = 0
+        self.calls = 0 # Calls and wall-clock time measured by the simulation
+        self.time = 0.0
         
     def init(self):
         pass
     
     def run(self,adsorbent = None, lattice = None, box = None):
-        pass
+        '''Return the change of the total energy, 0 when rejected'''
+        return 0.0
+
+    def trial_energy(self,atom,container,lattice = None,exclude = None,ff = None):
+        '''Energy and pair list of atom at a trial position, the lattice goes first so an overlap skips the rest'''
+        start = time.perf_counter()
+        ff = ff or self.ff
+        en = 0.0
+        if lattice is not None:
+            en = ff.one_atom(atom,lattice)
+        if en == math.inf:
+            index, pair = None, None
+        else:
+            index, pair = ff.one_atom_pairs(atom,container,exclude)
+            en += np.sum(pair)
+        if en == math.inf:
+            self.overlap += 1
+            self.time_overlap += time.perf_counter() - start
+        else:
+            self.n_full += 1
+            self.time_full += time.perf_counter() - start
+        return en, index, pair
         
+    def metropolis(self,log_prop):
+        '''Accept with probability min(1, exp(log_prop)) without overflow'''
+        return self.rng.random() < math.exp(min(0.0,log_prop))
+
     def accept_rate(self):
         return self.acceptance / self.total
+
+    def overlap_rate(self):
+        return self.overlap / self.total
+
+    def time_saved(self):
+        '''Estimated time saved by rejecting overlaps before the full energy'''
+        if self.overlap == 0 or self.n_full == 0:
+            return 0.0
+        return self.overlap * self.time_full / self.n_full - self.time_overlap
+
+    def cost(self):
+        '''Seconds per call'''
+        return self.time / self.calls if self.calls > 0 else math.nan
         
     def reset(self):
         self.total = 0
         self.acceptance = 0
+        self.overlap = 0
+        self.time_overlap = 0.0
+        self.time_full = 0.0
+        self.n_full = 0
+        self.calls = 0
+        self.time = 0.0
+
+def rosenbluth(en,temperature):
+    '''Log of the mean Boltzmann factor of the trial energies, -inf when they all overlap'''
+    low = en.min()
+    if low == math.inf:
+        return -math.inf
+    return math.log(np.exp((low - en) / temperature).sum() / len(en)) - low / temperature
+
+def move_terms(ff,box,i,atom):
+    '''Update the terms of the box for particle i moving to atom, before it is stored'''
+    old_index, old = ff.one_atom_terms(box.get(i),box,i)
+    new_index, new = ff.one_atom_terms(atom,box,i)
+    box.terms += new.sum(axis=0) - old.sum(axis=0)
+    box.particle_terms[old_index] -= old
+    box.particle_terms[new_index] += new
+    box.particle_terms[i] = new.sum(axis=0)
 
 # Translation step
 class StepTranslation(Step):
     def __init__(self):
         Step.__init__(self)
         self.d_max = 0.0
+        self.d_type = {} # d_max of each particle type set by the calibration, d_max when missing
+        self.type_total = {}
+        self.type_acceptance = {}
+        self.in_box = False # Move the particles of the box instead of the adsorbent
+        self.k_trial = 1 # Displacements scored together by the multiple-try move
         
-    def init(self,d_max, temperature = 273.15):
+    def init(self,d_max, temperature = 273.15, in_box = False):
         self.d_max = d_max
         self.temperature = temperature
+        self.in_box = in_box
+
+    def adjust(self, target = 0.5, d_limit = math.inf):
+        '''Scale the move of each type toward the target acceptance, return {p_index: (acceptance, d_max)}'''
+        result = {}
+        for p, total in self.type_total.items():
+            if total == 0:
+                continue
+            rate = self.type_acceptance[p] / total
+            d = self.d_type.get(p,self.d_max) * min(2.0,max(0.5,rate / target))
+            self.d_type[p] = min(d,d_limit)
+            result[p] = (rate,self.d_type[p])
+        return result
+
+    def reset(self):
+        Step.reset(self)
+        self.type_total = {}
+        self.type_acceptance = {}
         
     def run(self,adsorbent = None, lattice = None, box = None):
-        if box == None:
-            container = adsorbent
-        else:
+        if self.in_box:
             container = box
-        if len(container.atoms) == 0:
-            return
-        atom = container.atoms.pop(random.randrange(len(container.atoms)))
-        old_en = self.ff.one_atom(atom,container)
-        if lattice != None:
-            old_en += self.ff.one_atom(atom,lattice)
-        # Move atom
-        new_atom = atom.copy()
-        new_atom.x += self.d_max * (random.random()-0.5)
-        new_atom.y += self.d_max * (random.random()-0.5)
-        new_atom.z += self.d_max * (random.random()-0.5)
-        container.check(new_atom)
-        new_en = self.ff.one_atom(new_atom,container)
-        if lattice != None:
-            new_en += self.ff.one_atom(new_atom,lattice)
+            lattice = None
+        else:
+            container = adsorbent
+        if len(container) == 0:
+            return 0.0
+        i = self.rng.randrange(len(container))
+        if self.k_trial > 1:
+            return self.run_multiple(container,lattice,box,i)
+        atom = container.load_trial(i)
+        p = atom.p_index
+        d_max = self.d_type.get(p,self.d_max)
+        old_en = container.energy[i] # The ledger holds the energy at the stored position
+        # Move the trial atom, the stored particle is untouched until acceptance
+        atom.x += d_max * (self.rng.random()-0.5)
+        atom.y += d_max * (self.rng.random()-0.5)
+        atom.z += d_max * (self.rng.random()-0.5)
+        container.check(atom)
+        new_en, new_index, new_pair = self.trial_energy(atom,container,lattice,i)
         self.total += 1
-        if random.random() < math.exp((old_en - new_en) / self.temperature): # Energy conversion
-            container.atoms.append(new_atom)
+        self.type_total[p] = self.type_total.get(p,0) + 1
+        if new_en == math.inf:
+            return 0.0
+        if self.rng.random() < math.exp(min(0.0,(old_en - new_en) / self.temperature)): # Energy conversion
+            # The old pairs are only needed to update the neighbours once the move is accepted
+            old_index, old_pair = self.ff.one_atom_pairs(container.get(i),container,i)
+            if self.in_box:
+                move_terms(self.ff,box,i,atom)
+            container.store_trial(i)
+            container.energy[old_index] -= old_pair
+            container.energy[new_index] += new_pair
+            container.energy[i] = new_en
             self.acceptance += 1
-        else:
-            container.atoms.append(atom)
+            self.type_acceptance[p] = self.type_acceptance.get(p,0) + 1
+            return float(new_en - old_en)
+        return 0.0
+
+    def trial_energies(self,coord,atom,container,lattice,i):
+        '''Energy of particle i at each of the (k,3) positions'''
+        en = self.ff.many_atoms(coord,atom.p_index,atom.charge,container,exclude=i)
+        if lattice != None:
+            en += self.ff.many_atoms(coord,atom.p_index,atom.charge,lattice)
+        return en
+
+    def run_multiple(self,container,lattice,box,i):
+        '''Multiple-try Metropolis: choose one of k_trial displacements by its Boltzmann weight,
+        k_trial-1 displacements around it and the old position form the reverse weight'''
+        start = time.perf_counter()
+        atom = container.load_trial(i)
+        p = atom.p_index
+        d_max = self.d_type.get(p,self.d_max)
+        old = np.array([atom.x,atom.y,atom.z])
+        self.total += 1
+        self.type_total[p] = self.type_total.get(p,0) + 1
+        coord = old + d_max * (self.rng.array((self.k_trial,3)) - 0.5)
+        en = self.trial_energies(coord,atom,container,lattice,i)
+        log_new = rosenbluth(en,self.temperature)
+        if log_new == -math.inf:
+            self.overlap += 1
+            self.time_overlap += time.perf_counter() - start
+            return 0.0
+        j = self.rng.choice(np.cumsum(np.exp(-(en - en.min()) / self.temperature)))
+        old_en = container.energy[i]
+        reverse = coord[j] + d_max * (self.rng.array((self.k_trial-1,3)) - 0.5)
+        log_old = rosenbluth(np.append(self.trial_energies(reverse,atom,container,lattice,i),old_en),self.temperature)
+        if not self.metropolis(log_new - log_old):
+            return 0.0
+        atom.x, atom.y, atom.z = coord[j]
+        container.check(atom)
+        new_en, new_index, new_pair = self.trial_energy(atom,container,lattice,i)
+        old_index, old_pair = self.ff.one_atom_pairs(container.get(i),container,i)
+        if self.in_box:
+            move_terms(self.ff,box,i,atom)
+        container.store_trial(i)
+        container.energy[old_index] -= old_pair
+        container.energy[new_index] += new_pair
+        container.energy[i] = new_en
+        self.acceptance += 1
+        self.type_acceptance[p] = self.type_acceptance.get(p,0) + 1
+        return float(new_en - old_en)
 
 # Add a particle to a box / adsorbent class
 class StepAdd(Step):
@@ -77,6 +223,7 @@ class StepAdd(Step):
         self.mu = 0.0
         self.lamb3 = 0.0 # De broglie wavelength
         self.atom = Atom()
+        self.k_trial = 1 # Trial positions of the multiple-try insertion, the same as StepRemove
     
     def init(self, atom, mass, pressure, temperature = 273.15):
         self.pressure = pressure
@@ -88,21 +235,62 @@ class StepAdd(Step):
         
         
     def run(self,adsorbent = None, lattice = None, box = None):
-        x = random.random()
-        y = random.random()
-        z = random.random()
+        if self.k_trial > 1:
+            return self.run_multiple(adsorbent,lattice)
+        x = self.rng.random()
+        y = self.rng.random()
+        z = self.rng.random()
         coord = np.dot(lattice.to_cartesian,[x,y,z])
         
-        atom = self.atom.copy()
+        atom = adsorbent.trial
+        atom.copy_from(self.atom)
         atom.x = coord[0]
         atom.y = coord[1]
         atom.z = coord[2]
-        en = self.ff.one_atom(atom,adsorbent) + self.ff.one_atom(atom,lattice)
-        prop = lattice.volume/self.lamb3/(len(adsorbent.atoms)+1)*math.exp((self.mu-en)/self.temperature) # Energy conversion
+        en, index, pair = self.trial_energy(atom,adsorbent,lattice)
+        self.total += 1
+        if en == math.inf:
+            return 0.0
+        correction = self.ff.correction(atom,adsorbent,lattice)
+        prop = lattice.volume/self.lamb3/(len(adsorbent)+1)*math.exp((self.mu-en-correction)/self.temperature) # Energy conversion
+        if self.rng.random() < prop:
+            self.acceptance += 1
+            adsorbent.energy[index] += pair
+            adsorbent.append_trial()
+            adsorbent.energy[-1] = en
+            return float(en + correction)
+        return 0.0
+
+    def run_multiple(self,adsorbent,lattice):
+        '''Score k_trial random positions in one batch and insert one of them chosen by its Boltzmann weight'''
+        start = time.perf_counter()
+        coord = np.dot(self.rng.array((self.k_trial,3)),lattice.to_cartesian.T)
+        en_lattice = self.ff.many_atoms(coord,self.atom.p_index,self.atom.charge,lattice)
+        en = en_lattice.copy()
+        free = en_lattice < math.inf # Positions overlapping the framework are not scored against the adsorbent
+        en[free] += self.ff.many_atoms(coord[free],self.atom.p_index,self.atom.charge,adsorbent)
         self.total += 1
-        if random.random() < prop:
+        log_w = rosenbluth(en,self.temperature)
+        if log_w == -math.inf:
+            self.overlap += 1
+            self.time_overlap += time.perf_counter() - start
+            return 0.0
+        atom = adsorbent.trial
+        atom.copy_from(self.atom)
+        correction = self.ff.correction(atom,adsorbent,lattice)
+        prop = lattice.volume/self.lamb3/(len(adsorbent)+1)*math.exp(log_w + (self.mu-correction)/self.temperature) # Energy conversion
+        if self.rng.random() < prop:
+            weight = np.exp(-(en - en.min()) / self.temperature)
+            j = self.rng.choice(np.cumsum(weight))
+            atom.x, atom.y, atom.z = coord[j]
+            index, pair = self.ff.one_atom_pairs(atom,adsorbent)
+            en = en_lattice[j] + np.sum(pair)
             self.acceptance += 1
-            adsorbent.atoms.append(atom)
+            adsorbent.energy[index] += pair
+            adsorbent.append_trial()
+            adsorbent.energy[-1] = en
+            return float(en + correction)
+        return 0.0
 
 # Remove a particle from a box/adsorbent
 class StepRemove(Step):
@@ -111,6 +299,7 @@ class StepRemove(Step):
         self.pressure = 0.0
         self.mu = 0.0
         self.lamb3 = 0.0
+        self.k_trial = 1 # Must match the k_trial of StepAdd
     
     def init(self, mass, pressure, temperature = 273.15):
         self.pressure = pressure
@@ -120,22 +309,35 @@ class StepRemove(Step):
         self.mu = temperature * math.log(self.lamb3 * pressure / BOLTZMANN_ANGSTROM / temperature) # Unit mu/kB in K
         
     def run(self,adsorbent = None, lattice = None, box = None):
-        if len(adsorbent.atoms) > 0 :
-            atom = adsorbent.atoms.pop(random.randrange(len(adsorbent.atoms)))
-            en = self.ff.one_atom(atom,adsorbent) + self.ff.one_atom(atom,lattice)
-            prop = self.lamb3*(len(adsorbent.atoms)+1) / lattice.volume * math.exp((en-self.mu)/self.temperature) # Energy conversion
+        if len(adsorbent) > 0 :
+            i = self.rng.randrange(len(adsorbent))
+            atom = adsorbent.load_trial(i)
+            # The energy of the particle is kept by the container, only the correction is computed
+            en = adsorbent.energy[i] + self.ff.correction(atom,adsorbent,lattice,i)
+            if self.k_trial > 1:
+                # Reverse move of the multiple-try insertion, the particle is one of the k_trial positions
+                coord = np.dot(self.rng.array((self.k_trial-1,3)),lattice.to_cartesian.T)
+                trial = self.ff.many_atoms(coord,atom.p_index,atom.charge,lattice) + self.ff.many_atoms(coord,atom.p_index,atom.charge,adsorbent,exclude=i)
+                log_w = rosenbluth(np.append(trial,adsorbent.energy[i]),self.temperature)
+                prop = self.lamb3*len(adsorbent) / lattice.volume * math.exp((en-adsorbent.energy[i]-self.mu)/self.temperature - log_w)
+            else:
+                prop = self.lamb3*len(adsorbent) / lattice.volume * math.exp((en-self.mu)/self.temperature) # Energy conversion
             self.total += 1
-            if random.random() < prop:
+            if self.rng.random() < prop:
                 self.acceptance += 1
-            else:
-                adsorbent.atoms.append(atom)
+                index, pair = self.ff.one_atom_pairs(atom,adsorbent,i)
+                adsorbent.energy[index] -= pair
+                adsorbent.remove(i)
+                return float(-en)
+        return 0.0
     
 
-# Change volume step
+# Change volume step of the box, the force field of the box has no cutoff
 class StepVolume(Step):
     def __init__(self):
         Step.__init__(self)
         self.pressure = 0.0
+        self.d_logV = 0.1
         
     def init(self,pressure,d_logV,temperature = 273.15):
         self.pressure = pressure
@@ -143,35 +345,35 @@ class StepVolume(Step):
         self.temperature = temperature
         
     def run(self,adsorbent = None, lattice = None, box = None):
-        en_old = self.ff.box(box)
         side_old = box.side
         logV = 3 * math.log(side_old)
-        logV += self.d_logV * (random.random() - 0.5)
+        logV += self.d_logV * (self.rng.random() - 0.5)
         side_new = math.exp(logV/3)
         k = side_new / side_old
-        for atom in box.atoms:
-            atom.x *= k
-            atom.y *= k
-            atom.z *= k
-        en_new = self.ff.box(box)
-        n = len(box.atoms)
-        prop = k **(3*n + 3) * math.exp( 
-            (en_old - en_new + self.pressure*(side_old ** 3 - side_new **3) / BOLTZMANN_ANGSTROM ) / self.temperature )
+        # Every minimum image distance scales by k, so does each power of r in the energy
+        scale = np.array([k ** -12,k ** -6,1 / k])
+        en_old = float(np.sum(box.terms))
+        en_new = float(np.dot(box.terms,scale))
+        n = len(box)
+        log_prop = (3*n + 3) * math.log(k) + (
+            en_old - en_new + self.pressure*(side_old ** 3 - side_new **3) / BOLTZMANN_ANGSTROM ) / self.temperature
         self.total += 1
-        if random.random() < prop:
+        if self.metropolis(log_prop):
             self.acceptance += 1
-            box.side = side_new
-            box.volume = side_new ** 3
-        else:
-            for atom in box.atoms:
-                atom.x /= k
-                atom.y /= k
-                atom.z /= k
+            pos = box.pos
+            pos *= k
+            box.set_side(side_new)
+            box.terms *= scale
+            box.particle_terms[:] *= scale # Each particle mixes the three powers differently
+            box.energy[:] = box.particle_terms.sum(axis=1)
+            return en_new - en_old
+        return 0.0
 
-# Swap the particle between box
+# Swap a particle between the adsorbent and the box
 class StepSwap(Step):
     def __init__(self):
         Step.__init__(self)
+        self.ff_box = None # ForceField of the box, without cutoff
         self.total_to_box = 0
         self.total_to_adsorbent = 0
         self.acceptance_to_box = 0
@@ -179,43 +381,75 @@ class StepSwap(Step):
     
     def init(self, temperature = 273.15):
         self.temperature = temperature
+
+    def reset(self):
+        Step.reset(self)
+        self.total_to_box = 0
+        self.total_to_adsorbent = 0
+        self.acceptance_to_box = 0
+        self.acceptance_to_adsorbent = 0
         
     def run(self,adsorbent = None, lattice = None, box = None):
-        self.total += 1
-        if random.random() < 0.5:
+        if self.rng.random() < 0.5:
             # Change from the box to the adsorbent
-            r = random.randrange(len(box.atoms))
-            coord = np.dot(adsorbent.to_cartesian,[random.random(),random.random(),random.random()])
-            atom = box.atoms[r].copy()
-            atom.x = coord[0]
-            atom.y = coord[1]
-            atom.z = coord[2]
-            en_old = ff.one_atom(box.atom[r],box)
-            en_new = ff.one_atom(atom,adsorbent) + ff.one_atom(atom,lattice)
-            prop = adsorbent.volume / (len(adsorbent.atoms)+1) * len(box.atoms) / box.volume * math.exp((en_old - en_new) / self.temperature)
+            if len(box) == 0:
+                return 0.0
+            self.total += 1
             self.total_to_adsorbent += 1
-            if random.random() < prop:
+            r = self.rng.randrange(len(box))
+            source = box.load_trial(r)
+            en_old = float(np.sum(self.ff_box.one_atom_pairs(source,box,r)[1]))
+            atom = adsorbent.trial
+            atom.copy_from(source)
+            atom.x, atom.y, atom.z = np.dot(lattice.to_cartesian,[self.rng.random(),self.rng.random(),self.rng.random()])
+            en, index, pair = self.trial_energy(atom,adsorbent,lattice)
+            if en == math.inf:
+                return 0.0
+            en_new = en + self.ff.correction(atom,adsorbent,lattice)
+            log_prop = math.log(lattice.volume / (len(adsorbent)+1) * len(box) / box.volume) + (en_old - en_new) / self.temperature
+            if self.metropolis(log_prop):
                 self.acceptance += 1
                 self.acceptance_to_adsorbent += 1
-                adsorbent.append(atom)
-                del box.atoms[r]
-            
+                adsorbent.energy[index] += pair
+                adsorbent.append_trial()
+                adsorbent.energy[-1] = en
+                index, pair = self.ff_box.one_atom_pairs(source,box,r)
+                box.energy[index] -= pair
+                index, terms = self.ff_box.one_atom_terms(source,box,r)
+                box.terms -= terms.sum(axis=0)
+                box.particle_terms[index] -= terms
+                box.remove(r)
+                return float(en_new - en_old)
         else:
-            r = random.randrange(len(adsorbent.atoms))
-            atom = adsorbent.atoms[r].copy()
-            atom.x = random.random() * box.side
-            atom.y = random.random() * box.side
-            atom.z = random.random() * box.side
-            en_old = ff.one_atom(box.atom[r],adsorbent) + ff.one_atom(box.atom[r],lattice)
-            en_new = ff.one_atom(atom,box)
-            prop = box.volume / (len(box.atoms)+1) * len(adsorbent.atoms) / adsorbent.volume * math.exp((en_old - en_new) / self.temperature)
+            # Change from the adsorbent to the box
+            if len(adsorbent) == 0:
+                return 0.0
+            self.total += 1
             self.total_to_box += 1
-            if random.random() < prop:
+            r = self.rng.randrange(len(adsorbent))
+            source = adsorbent.load_trial(r)
+            en_old = adsorbent.energy[r] + self.ff.correction(source,adsorbent,lattice,r)
+            atom = box.trial
+            atom.copy_from(source)
+            atom.x = self.rng.random() * box.side
+            atom.y = self.rng.random() * box.side
+            atom.z = self.rng.random() * box.side
+            en_new, index, pair = self.trial_energy(atom,box,None,ff = self.ff_box)
+            if en_new == math.inf:
+                return 0.0
+            log_prop = math.log(box.volume / (len(box)+1) * len(adsorbent) / lattice.volume) + (en_old - en_new) / self.temperature
+            if self.metropolis(log_prop):
                 self.acceptance += 1
                 self.acceptance_to_box += 1
-                box.append(atom)
-                del adsorbent.atoms[r]
-    
-
-    
-    
+                box.energy[index] += pair
+                index, terms = self.ff_box.one_atom_terms(atom,box)
+                box.terms += terms.sum(axis=0)
+                box.particle_terms[index] += terms
+                box.append_trial()
+                box.energy[-1] = en_new
+                box.particle_terms[-1] = terms.sum(axis=0)
+                index, pair = self.ff.one_atom_pairs(source,adsorbent,r)
+                adsorbent.energy[index] -= pair
+                adsorbent.remove(r)
+                return float(en_new - en_old)
+        return 0.0
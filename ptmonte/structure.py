@@ -5,15 +5,290 @@ Last modified: 2017
 File: structure
 '''
 
+import os
+import re
 import random
+import itertools
 import numpy as np
 import math
+from fractions import Fraction
 from .atom import Atom
+from .cell import CellList, perpendicular_widths
+
+def parse_symmetry(expr):
+    '''Coefficients of x, y, z and the constant of one coordinate of a symmetry operator, e.g. -x+1/2'''
+    row = np.zeros(3)
+    constant = 0.0
+    for sign, term in re.findall(r'([+-]?)([^+-]+)',expr.replace(' ','').lower()):
+        value = -1.0 if sign == '-' else 1.0
+        axis = term[-1]
+        if axis in 'xyz':
+            coefficient = term[:-1].rstrip('*')
+            if coefficient != '':
+                value *= float(Fraction(coefficient))
+            row['xyz'.index(axis)] += value
+        else:
+            constant += value * float(Fraction(term))
+    return row, constant
+
+def unique_positions(frac, tolerance):
+    '''Index of the positions kept in order, a position is dropped when a kept one is closer than tolerance
+    The positions are hashed in cells at least tolerance wide, only the own and neighbour cells are compared'''
+    n = len(frac)
+    m = max(1,int(math.floor(1/tolerance)))
+    cell = np.floor(frac * m).astype(np.int64) % m
+    key = (cell[:,0] * m + cell[:,1]) * m + cell[:,2]
+    order = np.argsort(key,kind='stable')
+    sorted_key = key[order]
+    first = []
+    second = []
+    for shift in itertools.product((-1,0,1),repeat=3):
+        c = (cell + shift) % m
+        k = (c[:,0] * m + c[:,1]) * m + c[:,2]
+        left = np.searchsorted(sorted_key,k,side='left')
+        count = np.searchsorted(sorted_key,k,side='right') - left
+        # Every (i, j) with j in the shifted cell of i
+        i = np.repeat(np.arange(n),count)
+        start = np.repeat(left - np.cumsum(count) + count,count)
+        j = order[start + np.arange(len(i))]
+        mask = j < i
+        i = i[mask]
+        j = j[mask]
+        d = frac[i] - frac[j]
+        d -= np.round(d)
+        mask = np.sum(d*d,axis=1) < tolerance ** 2
+        first.append(i[mask])
+        second.append(j[mask])
+    # A cell narrower than 3 tolerances is its own neighbour, the same pair can be found twice
+    pairs = np.unique(np.stack((np.concatenate(first),np.concatenate(second)),axis=1),axis=0)
+    keep = np.ones(n,dtype=bool)
+    # Pairs are sorted by i, so every earlier position is settled when i is reached
+    bounds = np.flatnonzero(np.diff(pairs[:,0])) + 1
+    for group in np.split(pairs,bounds):
+        if len(group) > 0 and np.any(keep[group[:,1]]):
+            keep[group[0,0]] = False
+    return np.flatnonzero(keep)
+
+# Particles stored as contiguous arrays
+class Container:
+    def __init__(self):
+        self.n = 0
+        self.capacity = 0
+        self.buffer_pos = np.zeros((0,3)) # Cartesian coordinate
+        self.buffer_index = np.zeros(0,dtype=int) # Index in the ForceField
+        self.buffer_charge = np.zeros(0)
+        self.buffer_energy = np.zeros(0) # Energy of each particle with everything else
+        self.a_type = []
+        self.type_count = np.zeros(0,dtype=int) # Particles of each p_index, kept up to date by every change
+        self.trial = Atom() # Scratch slot for trial moves
+        self.to_cartesian = np.identity(3) # Columns are the cell vectors
+        self.to_internal = np.identity(3)
+        self.length = np.ones(3) # Diagonal of to_cartesian
+        self.orthogonal = True # Use length alone for the minimum image
+        self.rows = (np.identity(3).tolist(),np.identity(3).tolist())
+        self.cells = None # CellList when a cutoff is used
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def pos(self):
+        return self.buffer_pos[:self.n]
+
+    @property
+    def p_index(self):
+        return self.buffer_index[:self.n]
+
+    @property
+    def charge(self):
+        return self.buffer_charge[:self.n]
+
+    @property
+    def energy(self):
+        return self.buffer_energy[:self.n]
+
+    @property
+    def atoms(self):
+        '''Copy of the particles as Atom objects'''
+        return [self.get(i) for i in range(len(self))]
+
+    def reserve(self,capacity):
+        if capacity <= self.capacity:
+            return
+        pos = np.zeros((capacity,3))
+        pos[:self.n] = self.pos
+        index = np.zeros(capacity,dtype=int)
+        index[:self.n] = self.p_index
+        charge = np.zeros(capacity)
+        charge[:self.n] = self.charge
+        energy = np.zeros(capacity)
+        energy[:self.n] = self.energy
+        self.buffer_pos = pos
+        self.buffer_index = index
+        self.buffer_charge = charge
+        self.buffer_energy = energy
+        self.capacity = capacity
+
+    def get(self,i):
+        atom = Atom()
+        self.load(i,atom)
+        return atom
+
+    def load(self,i,atom):
+        atom.x = self.buffer_pos[i,0]
+        atom.y = self.buffer_pos[i,1]
+        atom.z = self.buffer_pos[i,2]
+        atom.a_type = self.a_type[i]
+        atom.p_index = int(self.buffer_index[i])
+        atom.charge = float(self.buffer_charge[i])
+
+    def write(self,i,atom):
+        self.buffer_pos[i,0] = atom.x
+        self.buffer_pos[i,1] = atom.y
+        self.buffer_pos[i,2] = atom.z
+        self.a_type[i] = atom.a_type
+        self.buffer_index[i] = atom.p_index
+        self.buffer_charge[i] = atom.charge
+
+    def count_types(self):
+        '''Count the particles of each type again after p_index is changed in place'''
+        self.type_count = np.bincount(self.p_index)
+
+    def add_count(self,p,k):
+        if p >= len(self.type_count):
+            self.type_count = np.concatenate((self.type_count,np.zeros(p + 1 - len(self.type_count),dtype=int)))
+        self.type_count[p] += k
+
+    def set(self,i,atom):
+        if atom.p_index != self.buffer_index[i]:
+            self.add_count(int(self.buffer_index[i]),-1)
+            self.add_count(atom.p_index,1)
+        self.write(i,atom)
+        if self.cells is not None:
+            self.cells.move(i,self.buffer_pos[i])
+
+    def append(self,atom):
+        if self.n == self.capacity:
+            self.reserve(max(16,2*self.capacity))
+        self.a_type.append(atom.a_type)
+        self.n += 1
+        self.write(self.n-1,atom)
+        self.add_count(atom.p_index,1)
+        self.buffer_energy[self.n-1] = 0.0
+        if self.cells is not None:
+            self.cells.insert(self.n-1,self.cells.cell(self.buffer_pos[self.n-1]))
+
+    def remove(self,i):
+        '''Delete particle i by moving the last particle into its slot'''
+        last = self.n - 1
+        self.type_count[self.buffer_index[i]] -= 1
+        if self.cells is not None:
+            self.cells.delete(i)
+            if i != last:
+                self.cells.rename(last,i)
+        if i != last:
+            self.buffer_pos[i] = self.buffer_pos[last]
+            self.buffer_index[i] = self.buffer_index[last]
+            self.buffer_charge[i] = self.buffer_charge[last]
+            self.buffer_energy[i] = self.buffer_energy[last]
+            self.a_type[i] = self.a_type[last]
+        self.a_type.pop()
+        self.n = last
+
+    def pop(self,i):
+        atom = self.get(i)
+        self.remove(i)
+        return atom
+
+    def load_trial(self,i):
+        self.load(i,self.trial)
+        return self.trial
+
+    def store_trial(self,i):
+        self.set(i,self.trial)
+
+    def append_trial(self):
+        self.append(self.trial)
+
+    def set_atoms(self,atoms):
+        self.n = 0
+        self.a_type = []
+        self.type_count[:] = 0
+        self.reserve(len(atoms))
+        for atom in atoms:
+            self.append(atom)
+
+    def state(self):
+        '''Compact copy of the particles as arrays'''
+        return {'pos': self.pos.copy(), 'p_index': self.p_index.copy(), 'charge': self.charge.copy(),
+                'energy': self.energy.copy(), 'a_type': np.array(self.a_type,dtype=str)}
+
+    def set_state(self,state):
+        n = len(state['pos'])
+        self.n = 0
+        self.reserve(n)
+        self.n = n
+        self.pos[:] = state['pos']
+        self.p_index[:] = state['p_index']
+        self.charge[:] = state['charge']
+        self.energy[:] = state['energy']
+        self.a_type = state['a_type'].tolist()
+        self.count_types()
+        if self.cells is not None:
+            self.init_cells(self.cells.cutoff)
+
+    def init_cells(self,cutoff):
+        '''Index the particles in a cell list, left off when the cell is narrower than 3 cutoffs'''
+        self.cells = CellList()
+        if not self.cells.init(self,cutoff):
+            self.cells = None
+
+    def set_cell(self,to_cartesian):
+        self.to_cartesian = to_cartesian
+        self.to_internal = np.linalg.inv(to_cartesian)
+        self.length = np.diag(to_cartesian).copy()
+        self.orthogonal = bool(np.all(np.abs(to_cartesian - np.diag(self.length)) < 1e-9 * np.max(self.length)))
+        self.rows = (to_cartesian.tolist(),self.to_internal.tolist()) # For the single atom wrapping in pure Python
+
+    def minimum_image(self,d):
+        '''Minimum image of an (...,3) array of displacement, through the fractional coordinate for a triclinic cell'''
+        if self.orthogonal:
+            return d - self.length * np.round(d / self.length)
+        f = np.dot(d,self.to_internal.T)
+        f -= np.round(f)
+        return np.dot(f,self.to_cartesian.T)
+
+    def wrap(self,pos):
+        '''Image inside the cell of an (...,3) array of position'''
+        if self.orthogonal:
+            return pos - self.length * np.floor(pos / self.length)
+        f = np.dot(pos,self.to_internal.T)
+        f -= np.floor(f)
+        return np.dot(f,self.to_cartesian.T)
+
+    def check(self,atom):
+        '''Wrap atom into the cell'''
+        if self.orthogonal:
+            lx, ly, lz = self.length
+            atom.x -= lx * math.floor(atom.x / lx)
+            atom.y -= ly * math.floor(atom.y / ly)
+            atom.z -= lz * math.floor(atom.z / lz)
+            return
+        cartesian, internal = self.rows
+        r = (atom.x,atom.y,atom.z)
+        f = [row[0]*r[0] + row[1]*r[1] + row[2]*r[2] for row in internal]
+        f = [x - math.floor(x) for x in f]
+        atom.x, atom.y, atom.z = [row[0]*f[0] + row[1]*f[1] + row[2]*f[2] for row in cartesian]
+
+    def shortest_r2(self,coord,pos):
+        '''Return the squared shortest distance from coord to each row of pos'''
+        d = self.minimum_image(pos - coord)
+        return np.einsum('ij,ij->i',d,d)
 
 # Class for Lattice
-class Lattice:
+class Lattice(Container):
     def __init__(self):
-        self.atoms = []
+        Container.__init__(self)
         self.internal_atoms = []
         self.a = 0.0
         self.b = 0.0
@@ -25,8 +300,33 @@ class Lattice:
         self.symmetry_x = []
         self.symmetry_y = []
         self.symmetry_z = []
+        self.tolerance = 0.01 # Fractional distance below which symmetry copies are merged
+        self.grid = None # EnergyGrid replacing the framework sum
+        self.occupancy = None # OccupancyMap of the hard core of the framework
+        self.counts = np.ones(3,dtype=int) # Copies of the unit cell along a, b, c made by supercell
+        self.n_cell = 1
         
     def init(self):
+        self.init_cell()
+        # Apply every symmetry operator to every atom at once
+        rotation = np.zeros((len(self.symmetry_x),3,3))
+        translation = np.zeros((len(self.symmetry_x),3))
+        for i, op in enumerate(zip(self.symmetry_x,self.symmetry_y,self.symmetry_z)):
+            for j in range(3):
+                rotation[i,j], translation[i,j] = parse_symmetry(op[j])
+        frac = np.array([[a.x,a.y,a.z] for a in self.internal_atoms]).reshape(-1,3)
+        frac = np.einsum('oij,aj->aoi',rotation,frac) + translation
+        frac = (frac - np.floor(frac)).reshape(-1,3)
+        keep = unique_positions(frac,self.tolerance)
+        source = keep // len(rotation)
+        # Framework atoms are stored in cartesian coordinate like the adsorbents
+        self.set_state({'pos': np.dot(frac[keep],self.to_cartesian.T),
+                        'p_index': np.zeros(len(keep),dtype=int),
+                        'charge': np.array([a.charge for a in self.internal_atoms])[source].reshape(-1),
+                        'energy': np.zeros(len(keep)),
+                        'a_type': np.array([a.a_type for a in self.internal_atoms],dtype=str)[source]})
+
+    def init_cell(self):
         k = math.pi/180.0 # radian conversion
         self.volume = self.a*self.b*self.c*math.sqrt(
             1 - math.cos(k*self.alpha)**2- math.cos(k*self.beta)**2 - math.cos(k*self.gamma)**2
@@ -38,41 +338,32 @@ class Lattice:
         self.to_cartesian[1,1] = self.b*math.sin(k*self.gamma)
         self.to_cartesian[1,2] = self.c*(math.cos(k*self.alpha)-math.cos(k*self.beta)*math.cos(k*self.gamma))/math.sin(k*self.gamma)
         self.to_cartesian[2,2] = self.volume / (self.a*self.b*math.sin(k*self.gamma))
-        self.to_internal = np.linalg.inv(self.to_cartesian)
-        # Generate the atoms coordinate
-        temp = []
-        for atom in self.internal_atoms:
-            for i in range(len(self.symmetry_x)):
-                x = atom.copy()
-                x.x = eval(self.symmetry_x[i].replace('x',str(atom.x)).replace('y',str(atom.y)).replace('z',str(atom.z)))
-                if x.x < 0:
-                    x.x += 1
-                if x.x > 1:
-                    x.x -= 1
-                x.y = eval(self.symmetry_y[i].replace('x',str(atom.x)).replace('y',str(atom.y)).replace('z',str(atom.z)))
-                if x.y < 0:
-                    x.y += 1
-                if x.y > 1:
-                    x.y -= 1
-                x.z = eval(self.symmetry_z[i].replace('x',str(atom.x)).replace('y',str(atom.y)).replace('z',str(atom.z)))
-                if x.z < 0:
-                    x.z += 1
-                if x.z > 1:
-                    x.z -= 1
-                temp.append(x)
-        # Check the repetation in temp
-        self.atoms = []
-        for i in range(len(temp)-1,-1,-1):
-            rep = False
-            atom = temp[i]
-            for j in range(i-1):
-                r2 = (atom.x - temp[j].x)**2 + (atom.y - temp[j].y)**2 + (atom.z - temp[j].z)**2
-                if r2 < 0.0001:
-                    rep = True
-                    break
-            if not rep:
-                self.atoms.append(atom)
-            del temp[i]
+        self.set_cell(self.to_cartesian)
+
+    def save_arrays(self,directory):
+        '''Write the expanded framework as .npy files, p_index included'''
+        os.makedirs(directory,exist_ok=True)
+        np.save(os.path.join(directory,'cell.npy'),[self.a,self.b,self.c,self.alpha,self.beta,self.gamma])
+        np.save(os.path.join(directory,'pos.npy'),self.pos)
+        np.save(os.path.join(directory,'p_index.npy'),self.p_index)
+        np.save(os.path.join(directory,'charge.npy'),self.charge)
+        np.save(os.path.join(directory,'a_type.npy'),np.array(self.a_type,dtype=str))
+        np.save(os.path.join(directory,'counts.npy'),self.counts)
+
+    def load_arrays(self,directory):
+        '''Read a framework written by save_arrays, the arrays are memory-mapped read-only'''
+        self.a, self.b, self.c, self.alpha, self.beta, self.gamma = [float(x) for x in np.load(os.path.join(directory,'cell.npy'))]
+        self.init_cell()
+        self.buffer_pos = np.load(os.path.join(directory,'pos.npy'),mmap_mode='r')
+        self.buffer_index = np.load(os.path.join(directory,'p_index.npy'),mmap_mode='r')
+        self.buffer_charge = np.load(os.path.join(directory,'charge.npy'),mmap_mode='r')
+        self.a_type = np.load(os.path.join(directory,'a_type.npy')).tolist()
+        if os.path.exists(os.path.join(directory,'counts.npy')):
+            self.counts = np.load(os.path.join(directory,'counts.npy'))
+            self.n_cell = int(np.prod(self.counts))
+        self.n = self.capacity = len(self.buffer_pos)
+        self.buffer_energy = np.zeros(self.n)
+        self.count_types()
         
     def read_cif(self,file_name):
         f = open(file_name,'r')
@@ -119,42 +410,35 @@ class Lattice:
                         self.internal_atoms.append(atom)
             temp = f.readline()
         f.close()
-        
-    def check(self,atom):
-        coord = [atom.x,atom.y,atom.z]
-        new_coord = np.dot(self.to_internal,coord)
-        for i in range(3):
-            while new_coord[i] < 0:
-                new_coord[i] += 1
-            while new_coord[i] > 1:
-                new_coord[i] -= 1
-        new_coord = np.dot(self.to_cartesian,new_coord)
-        atom.x = new_coord[0]
-        atom.y = new_coord[1]
-        atom.z = new_coord[2]
-    
-    def shortest_r2(self,a,b):
-        dx = a.x - b.x
-        dy = a.y - b.y
-        dz = a.z - b.z
-        if dx > self.a/2:
-            dx -= self.a/2
-        if dx < - self.a/2:
-            dx += self.a/2
-        if dy > self.b/2:
-            dy -= self.b/2
-        if dy < - self.b/2:
-            dy += self.b/2
-        if dz > self.c/2:
-            dz -= self.c/2
-        if dz < - self.c/2:
-            dz += self.c/2
-        return dx**2 + dy**2 + dz**2
+
+    def unit_cell(self):
+        '''Cartesian matrix of the unit cell before supercell'''
+        return self.to_cartesian / self.counts
+
+    def supercell(self,cutoff):
+        '''Replicate the cell until every perpendicular width is at least twice the cutoff, return the copies along a, b, c'''
+        counts = np.maximum(1,np.ceil(2 * cutoff / perpendicular_widths(self.to_cartesian) - 1e-9)).astype(int)
+        self.counts = self.counts * counts
+        self.n_cell = int(np.prod(self.counts))
+        if np.all(counts == 1):
+            return counts
+        shift = np.array(list(itertools.product(*[range(k) for k in counts])))
+        shift = np.dot(shift,self.to_cartesian.T)
+        state = self.state()
+        self.a, self.b, self.c = self.a * counts[0], self.b * counts[1], self.c * counts[2]
+        self.init_cell()
+        self.set_state({'pos': (shift[:,None,:] + state['pos'][None,:,:]).reshape(-1,3),
+                        'p_index': np.tile(state['p_index'],len(shift)),
+                        'charge': np.tile(state['charge'],len(shift)),
+                        'energy': np.zeros(len(shift) * len(state['pos'])),
+                        'a_type': np.tile(state['a_type'],len(shift))})
+        return counts
+
 
 # Class for adsorbents in lattice box
-class Adsorbent:
+class Adsorbent(Container):
     def __init__(self):
-        self.atoms = []
+        Container.__init__(self)
     
     def copy_lattice(self,lattice):
         self.a = lattice.a
@@ -164,81 +448,52 @@ class Adsorbent:
         self.beta = lattice.beta
         self.gamma = lattice.gamma
         self.volume = lattice.volume
-        self.to_cartesian = lattice.to_cartesian # Copy reference
-        self.to_internal = lattice.to_internal # Copy reference
-    
-    def check(self,atom):
-        coord = [atom.x,atom.y,atom.z]
-        new_coord = np.dot(self.to_internal,coord)
-        for i in range(3):
-            if new_coord[i] < 0:
-                new_coord[i] += 1
-            if new_coord[i] > 1:
-                new_coord[i] -= 1
-        new_coord = np.dot(self.to_cartesian,new_coord)
-        atom.x = new_coord[0]
-        atom.y = new_coord[1]
-        atom.z = new_coord[2]
-
-    def shortest_r2(self,a,b):
-        dx = a.x - b.x
-        dy = a.y - b.y
-        dz = a.z - b.z
-        if dx > self.a/2:
-            dx -= self.a/2
-        if dx < - self.a/2:
-            dx += self.a/2
-        if dy > self.b/2:
-            dy -= self.b/2
-        if dy < - self.b/2:
-            dy += self.b/2
-        if dz > self.c/2:
-            dz -= self.c/2
-        if dz < - self.c/2:
-            dz += self.c/2
-        return dx**2 + dy**2 + dz**2
+        self.set_cell(lattice.to_cartesian)
 
 # Lattice for adsorbent in another box
-class Box:
+class Box(Container):
     def __init__(self):
-        self.atoms = []
+        Container.__init__(self)
         self.side = 0.0
         self.volume = 0.0
-        
+        self.terms = np.zeros(3) # Running r**-12, r**-6 and r**-1 sums of the energy, see StepVolume
+        self.buffer_terms = np.zeros((0,3)) # The same sums for each particle, its energy is their total
+
     def init(self, side, n_particle):
+        self.set_side(side)
+        self.reserve(n_particle)
+
+    @property
+    def particle_terms(self):
+        return self.buffer_terms[:self.n]
+
+    def reserve(self,capacity):
+        if capacity <= self.capacity:
+            return
+        terms = np.zeros((capacity,3))
+        terms[:self.n] = self.particle_terms
+        self.buffer_terms = terms
+        Container.reserve(self,capacity)
+
+    def append(self,atom):
+        Container.append(self,atom)
+        self.buffer_terms[self.n-1] = 0.0
+
+    def remove(self,i):
+        self.buffer_terms[i] = self.buffer_terms[self.n-1]
+        Container.remove(self,i)
+
+    def state(self):
+        state = Container.state(self)
+        state['terms'] = self.particle_terms.copy()
+        return state
+
+    def set_state(self,state):
+        Container.set_state(self,state)
+        self.particle_terms[:] = state['terms']
+        self.terms = self.particle_terms.sum(axis=0) / 2
+
+    def set_side(self, side):
         self.side = side
         self.volume = side ** 3
-        
-        
-    def check(self,atom):
-        while atom.x > self.side:
-            atom.x -= self.side
-        while atom.x < 0:
-            atom.x += self.side
-        while atom.y > self.side:
-            atom.y -= self.side
-        while atom.y < 0:
-            atom.y += self.side
-        while atom.z > self.side:
-            atom.z -= self.side
-        while atom.z < 0:
-            atom.z += self.side
-        
-    def shortest_r2(self, a, b):
-        '''Return the shortest distance of two atom with'''
-        dx = a.x - b.x
-        dy = a.y - b.y
-        dz = a.z - b.z
-        if dx > self.side/2:
-            dx -= self.side/2
-        if dx < - self.side/2:
-            dx += self.side/2
-        if dy > self.side/2:
-            dy -= self.side/2
-        if dy < - self.side/2:
-            dy += self.side/2
-        if dz > self.side/2:
-            dz -= self.side/2
-        if dz < - self.side/2:
-            dz += self.side/2
-        return dx**2 + dy**2 + dz**2
+        self.set_cell(side * np.identity(3))
@@ -0,0 +1,147 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: tempering
+'''
+
+import copy
+import math
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from .constants import *
+from .simulation import Simulation, GrandCanonicalSimulation
+
+# Loop of a replica in its own process, driven by commands on the pipe
+def _replica_worker(conn, simulation, lattice, ff, a_type, seed):
+    simulation.seed(seed)
+    simulation.setup(lattice,ff,a_type)
+    while True:
+        command = conn.recv()
+        if command[0] == 'run':
+            simulation.run(command[1])
+            conn.send((simulation.energy,len(simulation.adsorbent)))
+        elif command[0] == 'get':
+            conn.send((simulation.adsorbent.state(),simulation.energy))
+        elif command[0] == 'set':
+            simulation.adsorbent.set_state(command[1])
+            simulation.energy = command[2]
+            conn.send(None)
+        elif command[0] == 'result':
+            rates = {type(step).__name__[4:].lower(): step.accept_rate() if step.total > 0 else np.nan
+                     for step in simulation.steps}
+            n_cell = simulation.lattice.n_cell # The simulated framework may be a supercell
+            conn.send((simulation.stat_adsorb.mean() / n_cell,simulation.stat_en.mean() / n_cell,n_cell,rates))
+        elif command[0] == 'reset':
+            simulation.reset()
+            conn.send(None)
+        else:
+            conn.close()
+            return
+
+# Grand canonical replicas at different temperatures / pressures exchanging configurations
+class ReplicaExchangeSimulation(Simulation):
+    def __init__(self):
+        Simulation.__init__(self)
+        self.simulation = GrandCanonicalSimulation() # Template for the settings of every replica
+        self.replicas = [] # (temperature, pressure) in the order of the exchange
+        self.n_exchange = 100 # Steps of each replica between swap attempts
+        self.processes = []
+        self.connections = []
+        self.energies = []
+        self.loadings = []
+        self.swap_total = []
+        self.swap_acceptance = []
+        self.n_cycle = 0
+
+    def init(self, lattice_file, ff_file, a_type, replicas = None):
+        if replicas is not None:
+            self.replicas = list(replicas)
+        lattice, ff = self.simulation.read(lattice_file,ff_file,a_type)
+        seeds = self.rng.seed_sequence.spawn(len(self.replicas)) # Set the root with seed() before init
+        for (temperature, pressure), seed in zip(self.replicas,seeds):
+            simulation = copy.deepcopy(self.simulation)
+            simulation.temperature = temperature
+            simulation.pressure = pressure
+            conn, child = mp.Pipe()
+            process = mp.Process(target=_replica_worker,args=(child,simulation,lattice,ff,a_type,seed),daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.connections.append(conn)
+        self.energies = [0.0] * len(self.replicas)
+        self.loadings = [0] * len(self.replicas)
+        self.swap_total = [0] * (len(self.replicas)-1)
+        self.swap_acceptance = [0] * (len(self.replicas)-1)
+
+    def log_activity(self, k):
+        temperature, pressure = self.replicas[k]
+        return math.log(pressure / BOLTZMANN_ANGSTROM / temperature)
+
+    def swap(self, k):
+        '''Metropolis exchange of the configurations of replica k and k+1'''
+        t_a, t_b = self.replicas[k][0], self.replicas[k+1][0]
+        u_a, u_b = self.energies[k], self.energies[k+1]
+        n_a, n_b = self.loadings[k], self.loadings[k+1]
+        prop = (1/t_a - 1/t_b) * (u_a - u_b) + (n_b - n_a) * (self.log_activity(k) - self.log_activity(k+1))
+        self.swap_total[k] += 1
+        if prop >= 0 or self.rng.random() < math.exp(prop):
+            self.swap_acceptance[k] += 1
+            self.connections[k].send(('get',))
+            self.connections[k+1].send(('get',))
+            state_a, en_a = self.connections[k].recv()
+            state_b, en_b = self.connections[k+1].recv()
+            self.connections[k].send(('set',state_b,en_b))
+            self.connections[k+1].send(('set',state_a,en_a))
+            self.connections[k].recv()
+            self.connections[k+1].recv()
+            self.energies[k], self.energies[k+1] = u_b, u_a
+            self.loadings[k], self.loadings[k+1] = n_b, n_a
+
+    def single_run(self):
+        for conn in self.connections:
+            conn.send(('run',self.n_exchange))
+        for k, conn in enumerate(self.connections):
+            self.energies[k], self.loadings[k] = conn.recv()
+        # Alternate the even and odd pairs
+        for k in range(self.n_cycle % 2,len(self.replicas)-1,2):
+            self.swap(k)
+        self.n_cycle += 1
+
+    def run(self, n_step):
+        '''Run n_step steps on every replica'''
+        for i in range(max(1,n_step // self.n_exchange)):
+            self.single_run()
+
+    def swap_rate(self):
+        return [a / t if t > 0 else np.nan for a, t in zip(self.swap_acceptance,self.swap_total)]
+
+    def accept_rate(self):
+        '''Loading and energy per unit cell, acceptance of every step and of the swap with the next replica, one row per replica'''
+        rows = []
+        swap = self.swap_rate() + [np.nan]
+        for k, conn in enumerate(self.connections):
+            conn.send(('result',))
+            loading, energy, n_cell, rates = conn.recv()
+            row = {'temperature': self.replicas[k][0], 'pressure': self.replicas[k][1], 'loading': loading, 'energy': energy,
+                   'n_cell': n_cell}
+            for name, rate in rates.items():
+                row['accept_' + name] = rate
+            row['accept_swap'] = swap[k]
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def reset(self):
+        for conn in self.connections:
+            conn.send(('reset',))
+            conn.recv()
+        self.swap_total = [0] * (len(self.replicas)-1)
+        self.swap_acceptance = [0] * (len(self.replicas)-1)
+
+    def close(self):
+        for conn in self.connections:
+            conn.send(('stop',))
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.connections = []
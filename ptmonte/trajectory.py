@@ -0,0 +1,124 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: trajectory
+'''
+
+import io
+import struct
+import queue
+import threading
+import numpy as np
+
+# Every chunk is an 8 byte length followed by a compressed npz archive
+_HEADER = struct.Struct('<Q')
+
+# Snapshots of a container written in compressed chunks by a background thread
+class TrajectoryWriter:
+    def __init__(self):
+        self.file_name = None
+        self.stride = 100 # Steps between two snapshots
+        self.chunk = 100 # Snapshots per compressed chunk
+        self.buffer = []
+        self.file = None
+        self.queue = None
+        self.thread = None
+        self.error = None # Exception of the writer thread, raised again in the simulation
+
+    def init(self, file_name, stride = 100, chunk = 100, size = None):
+        '''Append to file_name, cut at size bytes first when resuming from a checkpoint'''
+        self.file_name = file_name
+        self.stride = stride
+        self.chunk = chunk
+        self.buffer = []
+        self.error = None
+        self.file = open(file_name,'ab')
+        if size is not None:
+            self.file.truncate(size)
+            self.file.seek(size)
+        self.queue = queue.Queue(maxsize = 4) # Bound the memory when the disk is slower than the simulation
+        self.thread = threading.Thread(target = self._write, daemon = True)
+        self.thread.start()
+
+    def append(self, n_step, energy, container):
+        n = len(container)
+        self.buffer.append((n_step,energy,container.pos[:n].copy(),container.p_index[:n].copy()))
+        if len(self.buffer) >= self.chunk:
+            self.check()
+            self.queue.put(self.buffer)
+            self.buffer = []
+
+    def check(self):
+        if self.error is not None:
+            raise IOError('Trajectory {} could not be written'.format(self.file_name)) from self.error
+
+    def flush(self):
+        '''Write every pending snapshot, return the size of the file'''
+        if self.buffer:
+            self.queue.put(self.buffer)
+            self.buffer = []
+        self.queue.join()
+        self.check()
+        self.file.flush()
+        return self.file.tell()
+
+    def close(self):
+        if self.thread is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.file.close()
+            self.thread = None
+
+    def _write(self):
+        while True:
+            snapshots = self.queue.get()
+            if snapshots is None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error is None: # Chunks after a failure are dropped, the simulation stops at its next put
+                    self._write_chunk(snapshots)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write_chunk(self, snapshots):
+        count = [len(pos) for _, _, pos, _ in snapshots]
+        data = io.BytesIO()
+        np.savez_compressed(data,
+            step = np.array([s[0] for s in snapshots],dtype=np.int64),
+            energy = np.array([s[1] for s in snapshots]),
+            loading = np.array(count,dtype=np.int64),
+            pos = np.concatenate([s[2] for s in snapshots]).reshape(-1,3),
+            p_index = np.concatenate([s[3] for s in snapshots]))
+        data = data.getvalue()
+        self.file.write(_HEADER.pack(len(data)))
+        self.file.write(data)
+
+def read_chunks(file_name):
+    '''Iterate over the chunks of a trajectory as dictionaries of arrays'''
+    with open(file_name,'rb') as f:
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            data = f.read(_HEADER.unpack(header)[0])
+            with np.load(io.BytesIO(data)) as chunk:
+                yield {key: chunk[key] for key in chunk.files}
+
+def read_trajectory(file_name):
+    '''Whole trajectory, positions of snapshot k are pos[offset[k]:offset[k+1]]'''
+    chunks = list(read_chunks(file_name))
+    keys = ('step','energy','loading','pos','p_index')
+    if not chunks:
+        return {'step': np.zeros(0,dtype=np.int64), 'energy': np.zeros(0), 'loading': np.zeros(0,dtype=np.int64),
+                'pos': np.zeros((0,3)), 'p_index': np.zeros(0,dtype=int), 'offset': np.zeros(1,dtype=np.int64)}
+    result = {key: np.concatenate([chunk[key] for chunk in chunks]) for key in keys}
+    result['offset'] = np.concatenate(([0],np.cumsum(result['loading'])))
+    return result
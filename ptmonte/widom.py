@@ -0,0 +1,94 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: widom
+'''
+
+import math
+import numpy as np
+from .atom import Atom
+from .constants import *
+from .structure import Adsorbent
+from .rng import RandomStream
+from .simulation import GrandCanonicalSimulation
+
+def r_sequence(start, n, offset):
+    '''Points start ... start+n-1 of the additive recurrence of Roberts in the unit cube, shifted by offset'''
+    phi = 1.0
+    for i in range(30):
+        phi = (1 + phi) ** 0.25 # Root of x**4 = x + 1
+    alpha = np.array([1/phi, 1/phi**2, 1/phi**3])
+    frac = offset + np.outer(np.arange(start,start+n,dtype=float),alpha)
+    return frac - np.floor(frac)
+
+# Test particle insertion in the empty framework
+class Widom:
+    def __init__(self):
+        self.simulation = GrandCanonicalSimulation() # Settings of the framework and force field (cutoff, grid, ...)
+        self.temperature = 298.15
+        self.n_insertion = 1000000
+        self.chunk = 100000 # Positions of one batched call, each chunk is one block of the error
+        self.quasi_random = True # Roberts sequence with a random shift per chunk, uniform random numbers otherwise
+        self.rng = RandomStream()
+        self.lattice = None
+        self.ff = None
+        self.atom = None
+
+    def seed(self, seed = None):
+        self.rng = RandomStream(seed)
+
+    def init(self, lattice_file, ff_file, a_type):
+        self.lattice, self.ff = self.simulation.read(lattice_file,ff_file,a_type)
+        self.atom = Atom()
+        self.atom.a_type = a_type
+        self.ff.set_atom(self.atom)
+
+    def energies(self, frac):
+        '''Insertion energy at each fractional position, infinite on a hard-core overlap'''
+        coord = np.dot(frac,self.lattice.to_cartesian.T)
+        return self.ff.many_atoms(coord,self.atom.p_index,self.atom.charge,self.lattice)
+
+    def run(self):
+        '''Henry coefficient in molecules / (unit cell Pa), the Boltzmann averaged energy and the heat of adsorption in K'''
+        empty = Adsorbent()
+        empty.copy_lattice(self.lattice)
+        correction = self.ff.correction(self.atom,empty,self.lattice) # Tail and self energy do not depend on the position
+        # Sums over each chunk, the last one may be shorter
+        count = []
+        weight = []
+        weighted_energy = []
+        for start in range(0,self.n_insertion,self.chunk):
+            n = min(self.chunk,self.n_insertion - start)
+            if self.quasi_random:
+                frac = r_sequence(start,n,self.rng.array(3))
+            else:
+                frac = self.rng.array((n,3))
+            en = self.energies(frac) + correction
+            w = np.exp(-en / self.temperature)
+            count.append(n)
+            weight.append(np.sum(w))
+            weighted_energy.append(np.sum(w * np.where(w > 0,en,0.0))) # No inf * 0 on an overlap
+        count = np.array(count)
+        weight = np.array(weight)
+        weighted_energy = np.array(weighted_energy)
+        factor = self.lattice.volume / self.lattice.n_cell / (BOLTZMANN_ANGSTROM * self.temperature)
+        mean_w = np.sum(weight) / np.sum(count)
+        energy = np.sum(weighted_energy) / np.sum(weight)
+        # Jackknife leaving out one chunk at a time for the errors
+        n_block = len(weight)
+        if n_block > 1:
+            jack_w = (np.sum(weight) - weight) / (np.sum(count) - count)
+            jack_e = (np.sum(weighted_energy) - weighted_energy) / (np.sum(weight) - weight)
+            weight_error = math.sqrt((n_block - 1) / n_block * np.sum((jack_w - np.mean(jack_w)) ** 2))
+            energy_error = math.sqrt((n_block - 1) / n_block * np.sum((jack_e - np.mean(jack_e)) ** 2))
+        else:
+            energy_error = weight_error = math.nan
+        return {'henry': float(factor * mean_w),
+                'henry_error': float(factor * weight_error),
+                'energy': float(energy),
+                'energy_error': energy_error,
+                'heat': float(self.temperature - energy),
+                'heat_error': energy_error,
+                'n_insertion': self.n_insertion,
+                'n_cell': self.lattice.n_cell}
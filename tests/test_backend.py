@@ -0,0 +1,63 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_backend
+'''
+
+import copy
+import numpy as np
+import pytest
+from ptmonte.benchmark import synthetic_forcefield, synthetic_framework, synthetic_simulation
+
+pytest.importorskip('numba')
+
+CUTOFF = 10.0
+
+def forcefields(coulomb, core_factor):
+    ff = synthetic_forcefield(cutoff = CUTOFF,coulomb = coulomb)
+    ff.core_factor = core_factor
+    result = {}
+    for backend in ('numpy','numba'):
+        result[backend] = copy.copy(ff)
+        result[backend].backend = backend
+        result[backend].init()
+    assert result['numpy'].kernel is None and result['numba'].kernel is not None
+    return result['numpy'], result['numba']
+
+@pytest.mark.parametrize('shape', ['cubic','triclinic'])
+@pytest.mark.parametrize('side', [21.0,32.0]) # Without and with a cell list on the framework
+@pytest.mark.parametrize('coulomb', ['bare','wolf'])
+@pytest.mark.parametrize('core_factor', [None,0.6])
+def test_backends_agree(shape, side, coulomb, core_factor):
+    '''Every energy routine gives the same result with the NumPy and the Numba kernels'''
+    ff_numpy, ff_numba = forcefields(coulomb,core_factor)
+    lattice = synthetic_framework(ff_numpy,side = side,n_atom = 40,shape = shape)
+    simulation = synthetic_simulation(lattice,ff_numpy,15,seed = 5)
+    adsorbent = simulation.adsorbent
+    adsorbent.charge[:] = 0.2 * (-1) ** np.arange(len(adsorbent)) # Exercise the electrostatics between adsorbates
+    coord = np.dot(np.random.default_rng(6).random((50,3)),lattice.to_cartesian.T)
+    atom = simulation.steps[1].atom
+    results = []
+    for ff in (ff_numpy,ff_numba):
+        results.append([ff.total(adsorbent,lattice),
+                        ff.particle_energies(adsorbent,lattice),
+                        np.sum(ff.one_atom_pairs(adsorbent.get(3),adsorbent,3)[1]),
+                        ff.many_atoms(coord,atom.p_index,0.3,lattice),
+                        ff.many_atoms(coord,atom.p_index,0.3,adsorbent,exclude = 2),
+                        ff.many_atoms(coord,np.full(len(coord),atom.p_index),np.full(len(coord),0.3),adsorbent)])
+    for a, b in zip(*results):
+        assert np.allclose(a,b,rtol = 1e-10,atol = 1e-8)
+
+def test_backends_sample_the_same_chain():
+    '''The same seed gives the same moves and loading with both kernels, the energies agree to rounding'''
+    runs = []
+    for ff in forcefields('wolf',None):
+        lattice = synthetic_framework(ff,side = 21.0,n_atom = 40)
+        simulation = synthetic_simulation(lattice,ff,10,seed = 7,k_trial = 3)
+        simulation.keep_records = True
+        simulation.run(400)
+        runs.append(simulation)
+    assert runs[0].record_adsorb == runs[1].record_adsorb
+    assert np.allclose(runs[0].record_en,runs[1].record_en,rtol = 1e-9,atol = 1e-6)
+    assert np.allclose(runs[0].adsorbent.pos,runs[1].adsorbent.pos)
@@ -0,0 +1,16 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_benchmark
+'''
+
+import json
+from ptmonte import step
+from ptmonte.benchmark import run_benchmarks
+
+def test_every_step_is_timed():
+    result = run_benchmarks(sides = (21.0,),n_atoms = (20,),shapes = ('cubic',),loadings = (5,),n_step = 20,k_trial = 2,n_box = 10)
+    json.dumps(result) # No NaN or NumPy scalar left
+    timed = {row['step'].split('[')[0] for row in result['steps'] if row['moves_per_second'] is not None}
+    assert timed == {cls.__name__ for cls in step.Step.__subclasses__()}
@@ -0,0 +1,60 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_checkpoint
+'''
+
+import numpy as np
+from ptmonte.benchmark import synthetic_forcefield, synthetic_framework, synthetic_gibbs, synthetic_simulation
+
+CUTOFF = 10.0
+
+def framework():
+    ff = synthetic_forcefield(cutoff = CUTOFF)
+    return synthetic_framework(ff,side = 21.0,n_atom = 40), ff
+
+def simulation():
+    result = synthetic_simulation(*framework(),5,seed = 4)
+    result.keep_records = True
+    return result
+
+def test_resume_is_exact(tmp_path):
+    '''A run resumed from a checkpoint has the same particles and the same statistics as one run straight through'''
+    file_name = str(tmp_path / 'state.pkl')
+    straight = simulation()
+    straight.run(600)
+    first = simulation()
+    first.checkpoint_file = file_name
+    first.checkpoint_interval = 200
+    first.run(300) # The checkpoint of step 200 is the last one
+    resumed = simulation()
+    resumed.load_checkpoint(file_name)
+    assert resumed.n_step == 200
+    resumed.run(400)
+    assert np.array_equal(straight.adsorbent.pos,resumed.adsorbent.pos)
+    assert straight.energy == resumed.energy
+    assert straight.record_adsorb == resumed.record_adsorb
+    assert straight.record_en == resumed.record_en
+    assert len(straight.stat_adsorb) == len(resumed.stat_adsorb) == 600
+    assert straight.stat_adsorb.mean() == resumed.stat_adsorb.mean()
+    assert straight.stat_adsorb.errors() == resumed.stat_adsorb.errors()
+
+def test_gibbs_resume_keeps_the_box_forcefield(tmp_path):
+    '''The swap move shares the force field of the box after a restart, and the resumed run is exact'''
+    file_name = str(tmp_path / 'state.pkl')
+    straight = synthetic_gibbs(*framework(),3,n_particle = 20,seed = 5)
+    straight.run(300)
+    first = synthetic_gibbs(*framework(),3,n_particle = 20,seed = 5)
+    first.checkpoint_file = file_name
+    first.checkpoint_interval = 100
+    first.run(150)
+    resumed = synthetic_gibbs(*framework(),3,n_particle = 20,seed = 5)
+    resumed.load_checkpoint(file_name)
+    for step in resumed.steps:
+        assert step.ff is resumed.ff or step.ff is resumed.ff_box
+    assert resumed.steps[3].ff_box is resumed.ff_box
+    resumed.run(200)
+    assert np.array_equal(straight.adsorbent.pos,resumed.adsorbent.pos)
+    assert np.array_equal(straight.box.pos,resumed.box.pos)
+    assert straight.energy == resumed.energy
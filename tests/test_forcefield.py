@@ -0,0 +1,100 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_forcefield
+'''
+
+import itertools
+import numpy as np
+import pytest
+from ptmonte.forcefield import ForceField
+
+NAMES = ['C', 'C1', 'Cu', 'Cu1', 'Cu_5', 'Ca', 'O', 'O_H', 'Zn', 'H1', 'Hx']
+
+def forcefield(p_type, mixing = 'lorentz-berthelot'):
+    ff = ForceField()
+    ff.p_type = list(p_type)
+    ff.raw_sigma = [2.5 + 0.1 * i for i in range(len(p_type))]
+    ff.raw_epsilon = [20.0 + 5.0 * i for i in range(len(p_type))]
+    ff.mixing = mixing
+    ff.init()
+    return ff
+
+def linear_scan(p_type, a_type):
+    '''Exact match first, then the first wildcard X_ in file order with a_type starting with X'''
+    for num, name in enumerate(p_type):
+        if name == a_type:
+            return num
+    for num, name in enumerate(p_type):
+        if name[-1] == '_':
+            ind = name.find('_')
+            if name[:ind] == a_type[:ind]:
+                return num
+    return None
+
+@pytest.mark.parametrize('p_type', [list(p) + ['H1','Cu1'] for p in itertools.permutations(['C_','Cu_','O_H_'])])
+def test_find_type_matches_linear_scan(p_type):
+    '''Overlapping wildcards such as C_ and Cu_ resolve to the one listed first, exact names win'''
+    ff = forcefield(p_type)
+    for a_type in NAMES:
+        expected = linear_scan(p_type,a_type)
+        if expected is None:
+            with pytest.raises(ValueError):
+                ff.find_type(a_type)
+        else:
+            assert ff.find_type(a_type) == expected
+
+def test_find_type_is_memoised():
+    ff = forcefield(['Cu_','C_'])
+    assert 'Cu1' not in ff.lookup
+    assert ff.find_type('Cu1') == 0
+    assert ff.lookup['Cu1'] == 0
+    ff.lookup['Cu1'] = 1 # A second call reads the cache only
+    assert ff.find_type('Cu1') == 1
+    ff.init_lookup() # Rebuilt from p_type, the cache is dropped
+    assert ff.find_type('Cu1') == 0
+
+def test_unknown_type_names_it():
+    ff = forcefield(['C_','O'])
+    with pytest.raises(ValueError,match = 'Zn1'):
+        ff.find_type('Zn1')
+    assert 'Zn1' not in ff.lookup
+    with pytest.raises(ValueError): # O is exact, not a wildcard
+        ff.find_type('O1')
+
+@pytest.mark.parametrize('mixing', ['lorentz-berthelot','jorgensen'])
+def test_mixing_tables(mixing):
+    '''Vectorised tables against the pair by pair rules'''
+    ff = forcefield(['A','B','C','D'],mixing)
+    n = len(ff.p_type)
+    for i in range(n):
+        for j in range(n):
+            si, sj = ff.raw_sigma[i], ff.raw_sigma[j]
+            sigma = (si + sj) / 2 if mixing == 'lorentz-berthelot' else np.sqrt(si * sj)
+            epsilon4 = 4 * np.sqrt(ff.raw_epsilon[i] * ff.raw_epsilon[j])
+            assert ff.sigma2[i,j] == pytest.approx(sigma ** 2,rel = 1e-14)
+            assert ff.epsilon4[i,j] == pytest.approx(epsilon4,rel = 1e-14)
+            assert ff.c12[i,j] == pytest.approx(epsilon4 * sigma ** 12,rel = 1e-12)
+            assert ff.c6[i,j] == pytest.approx(epsilon4 * sigma ** 6,rel = 1e-12)
+    assert np.array_equal(ff.sigma2,ff.sigma2.T)
+
+def test_mixing_rules_differ_off_diagonal():
+    lorentz = forcefield(['A','B'])
+    jorgensen = forcefield(['A','B'],'jorgensen')
+    assert np.allclose(np.diag(lorentz.sigma2),np.diag(jorgensen.sigma2))
+    assert lorentz.sigma2[0,1] > jorgensen.sigma2[0,1] # Arithmetic against geometric mean
+    with pytest.raises(ValueError):
+        forcefield(['A'],'waldman-hagler')
+
+def test_read_mixing_rule(tmp_path):
+    file_name = tmp_path / 'force_field_mixing_rules.def'
+    file_name.write_text('# general rule for shifted vs truncated\nshifted\n# general rule tailcorrections\nno\n'
+                         '# number of defined interactions\n2\n# type interaction\n'
+                         'C_ lennard-jones 28.0 3.4\nO_ lennard-jones 48.0 3.0\n'
+                         '# general mixing rule for Lennard-Jones\nJorgensen\n')
+    ff = ForceField()
+    ff.read_raspa_def(str(file_name))
+    assert ff.shift and not ff.tail
+    assert ff.p_type == ['C_','O_']
+    assert ff.mixing == 'jorgensen'
@@ -0,0 +1,67 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_grid
+'''
+
+import os
+import numpy as np
+import pytest
+from ptmonte.benchmark import synthetic_forcefield, synthetic_framework
+from ptmonte.grid import EnergyGrid, cached_grid
+
+CUTOFF = 10.0
+SPACING = 1.0
+
+def framework(shape = 'cubic'):
+    ff = synthetic_forcefield(cutoff = CUTOFF)
+    return synthetic_framework(ff,side = 15.0,n_atom = 20,shape = shape), ff
+
+@pytest.mark.parametrize('shape', ['cubic','triclinic'])
+def test_grid_nodes_match_direct_sum(shape):
+    '''On its nodes the grid is the direct sum over the supercell, in every copy of the unit cell'''
+    lattice, ff = framework(shape)
+    p = ff.p_type.index('CH4_sp3')
+    grid = EnergyGrid()
+    grid.init(lattice,ff,[p],SPACING)
+    n = np.array(grid.shape)
+    rng = np.random.default_rng(10)
+    node = rng.integers(0,n,(1000,3)) / n + rng.integers(0,lattice.counts,(1000,3)) # Fraction of the unit cell
+    coord = np.dot(node,lattice.unit_cell().T)
+    direct = ff.many_atoms(coord,p,0.3,lattice)
+    free = np.abs(direct) < 1e4 # The grid clips the energy inside the framework atoms
+    assert np.sum(free) > 100
+    assert np.allclose(grid.energies(coord,p,0.3)[free],direct[free],rtol = 1e-9,atol = 1e-6)
+
+def test_has_takes_types_and_arrays():
+    lattice, ff = framework()
+    grid = EnergyGrid()
+    grid.init(lattice,ff,[4,2],SPACING)
+    assert grid.has(4) and grid.has(np.int64(2)) and not grid.has(0)
+    assert grid.has(np.array([2,4,4])) and not grid.has(np.array([2,3]))
+
+def test_cache_round_trip_is_keyed(tmp_path):
+    '''A second call loads the saved tables, a change of any setting builds another grid'''
+    lattice, ff = framework()
+    lattice_file = tmp_path / 'frame.cif'
+    ff_file = tmp_path / 'force_field.def'
+    lattice_file.write_text('frame')
+    ff_file.write_text('force field')
+    directory = str(tmp_path / 'grid')
+    p = ff.p_type.index('CH4_sp3')
+    first = cached_grid(directory,str(lattice_file),str(ff_file),lattice,ff,[p],SPACING)
+    second = cached_grid(directory,str(lattice_file),str(ff_file),lattice,ff,[p],SPACING)
+    assert isinstance(second.lj,np.memmap) and not isinstance(first.lj,np.memmap)
+    assert np.array_equal(first.lj,second.lj) and np.array_equal(first.coulomb,second.coulomb)
+    assert second.has(p) and second.shape == first.shape
+    assert len(os.listdir(directory)) == 1
+    cached_grid(directory,str(lattice_file),str(ff_file),lattice,ff,[p],2 * SPACING)
+    cached_grid(directory,str(lattice_file),str(ff_file),lattice,ff,[0,p],SPACING)
+    ff.shift = False
+    ff.init()
+    unshifted = cached_grid(directory,str(lattice_file),str(ff_file),lattice,ff,[p],SPACING)
+    assert not np.array_equal(unshifted.lj,first.lj)
+    ff_file.write_text('another force field')
+    cached_grid(directory,str(lattice_file),str(ff_file),lattice,ff,[p],SPACING)
+    assert len(os.listdir(directory)) == 5
@@ -0,0 +1,116 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_moves
+'''
+
+import numpy as np
+import pytest
+from ptmonte import GrandCanonicalSimulation, GibbsEnsembleSimulation
+from ptmonte.benchmark import ADSORBATE, synthetic_forcefield, synthetic_framework, synthetic_simulation
+
+CUTOFF = 10.0
+
+def framework(shape = 'cubic', shift = True, tail = False):
+    ff = synthetic_forcefield(cutoff = CUTOFF)
+    ff.shift = shift
+    ff.tail = tail
+    ff.init()
+    return synthetic_framework(ff,side = 21.0,n_atom = 40,shape = shape), ff
+
+def check_ledger(simulation):
+    '''Running total and particle energies against a recompute from scratch'''
+    adsorbent = simulation.adsorbent.energy.copy()
+    box = None if simulation.box is None else simulation.box.energy.copy()
+    terms = None if simulation.box is None else simulation.box.terms.copy()
+    particle_terms = None if simulation.box is None else simulation.box.particle_terms.copy()
+    for container in (simulation.lattice,simulation.adsorbent,simulation.box):
+        if container is not None:
+            count = np.bincount(container.p_index,minlength=len(container.type_count))
+            assert np.array_equal(container.type_count,count)
+    drift = simulation.recompute()
+    assert abs(drift) < 1e-6 * max(1.0,abs(simulation.energy))
+    assert np.allclose(adsorbent,simulation.adsorbent.energy,rtol = 1e-9,atol = 1e-6)
+    if box is not None:
+        assert np.allclose(box,simulation.box.energy,rtol = 1e-9,atol = 1e-6)
+        assert np.allclose(terms,simulation.box.terms,rtol = 1e-9,atol = 1e-6)
+        assert np.allclose(particle_terms,simulation.box.particle_terms,rtol = 1e-9,atol = 1e-6)
+
+@pytest.mark.parametrize('shape', ['cubic','triclinic'])
+@pytest.mark.parametrize('k_trial', [1,4])
+@pytest.mark.parametrize('p_step', [[1.0,0.0,0.0],[0.0,1.0,0.0],[0.0,0.0,1.0],[0.4,0.3,0.3]])
+def test_grand_canonical_drift(shape, k_trial, p_step):
+    lattice, ff = framework(shape)
+    simulation = synthetic_simulation(lattice,ff,10,seed = 1,k_trial = k_trial)
+    simulation.check_interval = 0
+    simulation.p_step = p_step
+    simulation.run(300)
+    assert sum(step.total for step in simulation.steps) > 0
+    check_ledger(simulation)
+
+@pytest.mark.parametrize('k_trial', [1,3])
+def test_gibbs_drift(k_trial):
+    lattice, ff = framework(shift = False,tail = True)
+    simulation = GibbsEnsembleSimulation()
+    simulation.temperature = 298.15
+    simulation.pressure = 1e6
+    simulation.d_max = 1.0
+    simulation.n_particle = 20
+    simulation.k_translation = k_trial
+    simulation.check_interval = 0
+    simulation.seed(2)
+    simulation.setup(lattice,ff,ADSORBATE)
+    simulation.run(1000)
+    assert simulation.steps[2].acceptance > 0 # Volume moves were accepted
+    check_ledger(simulation)
+
+def test_gibbs_needs_consistent_phases():
+    lattice, ff = framework(shift = True)
+    simulation = GibbsEnsembleSimulation()
+    with pytest.raises(ValueError):
+        simulation.setup(lattice,ff,ADSORBATE)
+
+def mean_loading(k_trial, k_translation):
+    lattice, ff = framework()
+    simulation = GrandCanonicalSimulation()
+    simulation.temperature = 298.15
+    simulation.pressure = 1e6
+    simulation.p_step = [0.2,0.4,0.4] # Exchange often so the loading decorrelates within the run
+    simulation.d_max = 1.0
+    simulation.k_trial = k_trial
+    simulation.k_translation = k_translation
+    simulation.check_interval = 0
+    simulation.seed(3)
+    simulation.setup(lattice,ff,ADSORBATE)
+    simulation.run(3000)
+    simulation.reset()
+    simulation.run(20000)
+    return simulation.stat_adsorb.mean(), simulation.stat_adsorb.error()
+
+def test_multiple_try_loading():
+    '''Multiple-try insertion, deletion and translation sample the same loading as the single moves'''
+    single, single_error = mean_loading(1,1)
+    multiple, multiple_error = mean_loading(4,4)
+    assert single > 1.0
+    assert np.isfinite(single_error) and np.isfinite(multiple_error) # The blocking reached its plateau
+    assert abs(single - multiple) < 4 * np.hypot(single_error,multiple_error)
+
+def test_schedule_measures_each_mix_once():
+    '''Every mix is run at most twice, the chosen one keeps insertion and deletion balanced'''
+    lattice, ff = framework()
+    simulation = synthetic_simulation(lattice,ff,5,seed = 2)
+    simulation.check_interval = 0
+    simulation.schedule(3000,n_block = 200)
+    runs = {}
+    for p_step, inefficiency, cost in simulation.record_schedule:
+        key = tuple(np.round(p_step,6))
+        runs[key] = runs.get(key,0) + 1
+        assert inefficiency >= 1.0 and len(cost) == 3
+    assert sum(runs.values()) == len(simulation.record_schedule) <= 15
+    assert max(runs.values()) <= 2
+    assert tuple(np.round(simulation.p_step,6)) in runs
+    assert sum(simulation.p_step) == pytest.approx(1.0)
+    assert simulation.p_step[1] == simulation.p_step[2]
+    assert min(simulation.p_step[0],2 * simulation.p_step[1]) >= simulation.p_min - 1e-12
+    assert all(step.calls == 0 for step in simulation.steps)
@@ -0,0 +1,71 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_statistics
+'''
+
+import math
+import numpy as np
+import pytest
+from ptmonte.statistics import BlockAverage
+
+N = 2 ** 16
+
+def averaged(x):
+    result = BlockAverage()
+    for value in x:
+        result.add(value)
+    return result
+
+def autoregressive(rng, phi, n):
+    '''AR(1) series of unit noise, its statistical inefficiency is (1+phi)/(1-phi)'''
+    noise = rng.normal(size = n)
+    x = np.empty(n)
+    x[0] = noise[0] / math.sqrt(1 - phi ** 2)
+    for i in range(1,n):
+        x[i] = phi * x[i-1] + noise[i]
+    return x
+
+def test_moments_match_numpy():
+    x = np.random.default_rng(0).normal(3.0,2.0,1000)
+    stat = averaged(x)
+    assert len(stat) == 1000
+    assert stat.mean() == pytest.approx(np.mean(x),rel = 1e-12)
+    assert stat.variance() == pytest.approx(np.var(x,ddof = 1),rel = 1e-10)
+    # The first level of the blocking is the naive standard error
+    assert stat.errors()[0] == pytest.approx(np.std(x,ddof = 1) / math.sqrt(len(x)),rel = 1e-10)
+
+@pytest.mark.parametrize('phi', [0.0,0.8])
+def test_error_and_inefficiency_of_correlated_series(phi):
+    x = autoregressive(np.random.default_rng(1),phi,N)
+    stat = averaged(x)
+    inefficiency = (1 + phi) / (1 - phi)
+    # The plateau takes the largest level, so the estimate leans high
+    assert 0.8 < stat.inefficiency() / inefficiency < 1.5
+    assert 0.9 < stat.error() / math.sqrt(inefficiency * np.var(x,ddof = 1) / N) < 1.25
+
+@pytest.mark.parametrize('n', [1000,4000])
+def test_no_error_before_the_plateau(n):
+    '''A correlation time longer than the blocks gives no error rather than an underestimate'''
+    stat = averaged(autoregressive(np.random.default_rng(2),0.995,n))
+    assert not stat.plateau()
+    assert math.isnan(stat.error()) and math.isnan(stat.inefficiency())
+    assert not stat.error() <= 1.0 # A run_converged target is never met
+
+def test_plateau_of_uncorrelated_series():
+    stat = averaged(np.random.default_rng(3).normal(size = 1000))
+    assert stat.plateau()
+    assert stat.error() == pytest.approx(1 / math.sqrt(1000),rel = 0.2)
+
+def test_empty_and_reset():
+    stat = BlockAverage()
+    assert math.isnan(stat.mean()) and math.isnan(stat.error()) and math.isnan(stat.inefficiency())
+    for value in range(100):
+        stat.add(float(value))
+    stat.reset()
+    assert len(stat) == 0 and math.isnan(stat.mean())
+    for value in [2.0] * 100:
+        stat.add(value)
+    assert stat.mean() == 2.0
+    assert math.isnan(stat.inefficiency()) # A constant series has no variance
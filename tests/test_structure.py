@@ -0,0 +1,149 @@
+'''
+Monte Carlo code
+written by: Thien-Phuc Tu-Nguyen
+Last modified: 2017
+File: test_structure
+'''
+
+import itertools
+import numpy as np
+import pytest
+from ptmonte.atom import Atom
+from ptmonte.cell import perpendicular_widths
+from ptmonte.structure import Lattice, unique_positions
+
+SKEWED = [(10.0,12.0,9.0,90.0,90.0,90.0),(10.0,10.0,10.0,80.0,95.0,105.0),(8.0,13.0,11.0,60.0,70.0,110.0),(12.0,9.0,10.0,120.0,100.0,65.0)]
+
+def brute_force(frac, tolerance):
+    '''Index of every position farther than tolerance from all the positions kept before it'''
+    keep = []
+    for i, f in enumerate(frac):
+        d = frac[keep] - f
+        d -= np.round(d)
+        if not np.any(np.sum(d*d,axis=1) < tolerance ** 2):
+            keep.append(i)
+    return np.array(keep,dtype=int)
+
+def separated(rng, n, distance):
+    '''n fractional positions at least distance apart under periodicity'''
+    result = []
+    while len(result) < n:
+        f = rng.random(3)
+        d = np.array(result).reshape(-1,3) - f
+        d -= np.round(d)
+        if np.all(np.sum(d*d,axis=1) > distance ** 2):
+            result.append(f)
+    return np.array(result)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_unique_positions_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    tolerance = 0.01
+    base = separated(rng,200,5 * tolerance)
+    # Near copies of a third of the positions, some of them across a face of the cell
+    copies = base[rng.choice(len(base),70,replace = False)] + rng.uniform(-0.3,0.3,(70,3)) * tolerance
+    edge = rng.random((10,3))
+    edge[:,rng.integers(3)] = 1e-4
+    edge_copies = edge.copy()
+    edge_copies[edge == 1e-4] = 1 - 1e-4
+    frac = np.concatenate((base,copies,edge,edge_copies))
+    frac = frac[rng.permutation(len(frac))]
+    frac -= np.floor(frac)
+    assert np.array_equal(unique_positions(frac,tolerance),brute_force(frac,tolerance))
+
+def test_distinct_positions_in_one_hash_cell_are_kept():
+    '''Positions farther than tolerance but closer than tolerance * sqrt(3) are distinct atoms'''
+    tolerance = 0.01
+    frac = np.array([[0.001,0.001,0.001],[0.01,0.01,0.01],[0.0105,0.0105,0.0105]])
+    assert unique_positions(frac,tolerance).tolist() == [0,1]
+    # A chain a - b - c with a, c apart keeps a and c
+    frac = np.array([[0.5,0.5,0.5],[0.508,0.5,0.5],[0.516,0.5,0.5]])
+    assert unique_positions(frac,tolerance).tolist() == [0,2]
+
+@pytest.mark.parametrize('tolerance', [0.03,0.1,0.4])
+def test_dense_positions_match_brute_force(tolerance):
+    '''Many neighbours within tolerance, including cells narrower than 3 tolerances'''
+    frac = np.random.default_rng(7).random((400,3))
+    assert np.array_equal(unique_positions(frac,tolerance),brute_force(frac,tolerance))
+
+def test_lattice_merges_special_positions():
+    '''An atom on an inversion centre appears once, a general atom twice'''
+    lattice = Lattice()
+    lattice.a = lattice.b = lattice.c = 10.0
+    lattice.alpha = lattice.beta = lattice.gamma = 90.0
+    for op in ('x,y,z','-x,-y,-z'):
+        x, y, z = op.split(',')
+        lattice.symmetry_x.append(x)
+        lattice.symmetry_y.append(y)
+        lattice.symmetry_z.append(z)
+    for position in ((0.5,0.5,0.0),(0.1,0.2,0.3)):
+        atom = Atom()
+        atom.x, atom.y, atom.z = position
+        atom.a_type = 'C'
+        lattice.internal_atoms.append(atom)
+    lattice.init()
+    assert len(lattice) == 3
+
+def cell(a, b, c, alpha, beta, gamma):
+    '''Lattice of one atom in a cell of the given lengths and angles'''
+    lattice = Lattice()
+    lattice.a, lattice.b, lattice.c = a, b, c
+    lattice.alpha, lattice.beta, lattice.gamma = alpha, beta, gamma
+    lattice.symmetry_x.append('x')
+    lattice.symmetry_y.append('y')
+    lattice.symmetry_z.append('z')
+    atom = Atom()
+    atom.x, atom.y, atom.z = 0.1, 0.2, 0.3
+    atom.a_type = 'C'
+    lattice.internal_atoms.append(atom)
+    lattice.init()
+    return lattice
+
+def nearest_image(lattice, d):
+    '''Shortest of the displacements d + n a + m b + l c over the images up to two cells away'''
+    shift = np.dot(np.array(list(itertools.product(range(-2,3),repeat = 3))),lattice.to_cartesian.T)
+    image = d[:,None,:] + shift[None,:,:]
+    return image[np.arange(len(d)),np.argmin(np.sum(image*image,axis=2),axis=1)]
+
+@pytest.mark.parametrize('shape', SKEWED)
+def test_minimum_image_matches_image_search(shape):
+    '''Pairs closer than half the narrowest perpendicular width get their nearest image'''
+    lattice = cell(*shape)
+    assert lattice.orthogonal == (shape[3:] == (90.0,90.0,90.0))
+    rng = np.random.default_rng(8)
+    pos = np.dot(rng.uniform(-1.5,2.5,(2000,3)),lattice.to_cartesian.T)
+    d = pos - np.dot(rng.random(3),lattice.to_cartesian.T)
+    expected = nearest_image(lattice,d)
+    near = np.sqrt(np.sum(expected*expected,axis=1)) < 0.5 * np.min(perpendicular_widths(lattice.to_cartesian))
+    assert np.sum(near) > 100
+    assert np.allclose(lattice.minimum_image(d)[near],expected[near],atol = 1e-9)
+    r2 = lattice.shortest_r2(np.zeros(3),d)
+    assert np.allclose(r2[near],np.sum(expected*expected,axis=1)[near],atol = 1e-9)
+
+@pytest.mark.parametrize('shape', SKEWED)
+def test_wrap_and_check_agree(shape):
+    '''Wrapped positions lie in the cell and differ from the original by a lattice vector'''
+    lattice = cell(*shape)
+    pos = np.dot(np.random.default_rng(9).uniform(-2.0,3.0,(200,3)),lattice.to_cartesian.T)
+    wrapped = lattice.wrap(pos)
+    frac = np.dot(wrapped,lattice.to_internal.T)
+    assert np.all(frac >= -1e-12) and np.all(frac < 1 + 1e-12)
+    shift = np.dot(pos - wrapped,lattice.to_internal.T)
+    assert np.allclose(shift,np.round(shift),atol = 1e-9)
+    atom = Atom()
+    for p, w in zip(pos,wrapped):
+        atom.x, atom.y, atom.z = p
+        lattice.check(atom)
+        assert np.allclose((atom.x,atom.y,atom.z),w,atol = 1e-9)
+
+@pytest.mark.parametrize('shape', SKEWED)
+@pytest.mark.parametrize('cutoff', [4.0,9.0,12.5])
+def test_supercell_is_wide_enough(shape, cutoff):
+    '''Every perpendicular width reaches twice the cutoff, one copy fewer along any axis does not'''
+    lattice = cell(*shape)
+    width = perpendicular_widths(lattice.to_cartesian)
+    counts = lattice.supercell(cutoff)
+    assert lattice.n_cell == np.prod(counts) == len(lattice)
+    assert np.all(perpendicular_widths(lattice.to_cartesian) >= 2 * cutoff - 1e-9)
+    assert np.allclose(perpendicular_widths(lattice.to_cartesian),width * counts)
+    assert np.all((counts == 1) | ((counts - 1) * width < 2 * cutoff))